@@ -21,37 +21,140 @@
 
 import argparse
 import datetime
+import functools
+import io
 import os
 import pwd
+import signal
 import sys
-import threading
 import time
 
-import dateutil.parser
 import lxml.etree as le
 from . import joshua_model
 
 JOSHUA_USER_ENV = "JOSHUA_USER"
 
-
+_YES_RESPONSES = frozenset(("y", "yes"))
+
+# Normalize each result layout yielded by joshua_model.tail_results, keyed
+# by tuple length, to (versionstamp, result_code, host, seed, output).
+_UNPACKERS = {
+    5: lambda r: r,
+    4: lambda r: (r[0], r[1], r[2], None, r[3]),
+    3: lambda r: (r[0], r[1], None, None, r[2]),
+    2: lambda r: (
+        r[0],
+        None,
+        None,
+        None,
+        str(joshua_model.fdb.tuple.unpack(r[1])[0]) + "\n",
+    ),
+}
+
+# Elements stripped from each record by "tail --simple".
+_SIMPLE_SKIP_TAGS = frozenset(("CodeCoverage", "BuggifySection"))
+
+
+# The passwd lookup can go out to a remote name service, and neither it nor
+# the environment override changes within a run.
+@functools.lru_cache(maxsize=1)
 def get_username():
     return os.environ.get(JOSHUA_USER_ENV, pwd.getpwuid(os.getuid())[0])
 
 
+def _simple_skip(elem):
+    return elem.tag in _SIMPLE_SKIP_TAGS or elem.get("Severity") == "30"
+
+
+def _simplify_element(elem):
+    if _simple_skip(elem):
+        return b""
+    # Materialize the matches first since removal mutates the tree.
+    for child in [c for c in elem.iterdescendants(le.Element) if _simple_skip(c)]:
+        child.getparent().remove(child)
+    return le.tostring(elem)
+
+
+def _simplify_trace(data):
+    """
+    Yield the serialized top-level elements of a trace record, minus the ones
+    "tail --simple" filters out. The record is parsed incrementally and each
+    element is dropped from the tree once yielded, so the tree doesn't grow
+    with the record; the record's bytes, and whatever the caller keeps of the
+    output, are still held in memory. As with lxml's remove(), a filtered
+    element's tail text goes with it.
+
+    >>> simplify = lambda data: b"".join(_simplify_trace(data))
+    >>> simplify(b'lead &lt;&#65;&gt; <A Severity="40"/>tail')
+    b'lead &lt;A&gt; <A Severity="40"/>tail'
+    >>> simplify(b'<CodeCoverage/>gone<BuggifySection/>gone<A Severity="30"/>gone<B/>')
+    b'<B/>'
+    >>> simplify(b'<A>x<CodeCoverage/>gone<B><BuggifySection/></B></A>end')
+    b'<A>x<B/></A>end'
+    >>> simplify(b'<A><B Severity="30"/>gone &amp;</A><C/>')
+    b'<A/><C/>'
+    >>> simplify(b'')
+    b''
+    """
+    root = None
+    depth = 0
+    text_done = False
+    for event, elem in le.iterparse(
+        io.BytesIO(b"<Dummy>" + data + b"</Dummy>"),
+        events=("start", "end"),
+        huge_tree=True,
+        collect_ids=False,
+        resolve_entities=False,
+        no_network=True,
+    ):
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                root = elem
+            if depth != 2:
+                continue
+        else:
+            depth -= 1
+            if depth != 0:
+                continue
+        # Either a new top-level element has begun or the record is over, so
+        # every earlier top-level element (including its tail) is complete.
+        if not text_done:
+            text_done = True
+            if root.text:
+                # Serialize the text escaped; [3:-4] strips "<x>" and "</x>".
+                holder = le.Element("x")
+                holder.text = root.text
+                yield le.tostring(holder)[3:-4]
+        done = 0
+        for child in root:
+            if child is elem:
+                break
+            yield _simplify_element(child)
+            done += 1
+        del root[:done]
+
+
 def format_ensemble(e, props):
+    fmt = "{}={}".format
     return "  %-50s %s" % (
         e,
-        " ".join("{}={}".format(k, v) for k, v in sorted(props.items())),
+        " ".join([fmt(k, v) for k, v in sorted(props.items())]),
     )
 
 
 def timestamp_of(time_string):
-    # FIXME: Right now this only uses local time. It should probably handle timezones/DST better.
-    return (
-        int(time.mktime(dateutil.parser.parse(time_string).timetuple()))
-        if time_string is not None
-        else None
-    )
+    # Times without an explicit offset are taken as local time.
+    if time_string is None:
+        return None
+    try:
+        dt = datetime.datetime.fromisoformat(time_string)
+    except ValueError:
+        # Only pay for dateutil when the input isn't ISO 8601.
+        import dateutil.parser
+
+        dt = dateutil.parser.parse(time_string)
+    return int(dt.timestamp())
 
 
 def get_active_ensembles(stopped, sanity=False, username=None):
@@ -72,12 +175,9 @@ def list_active_ensembles(
         print(format_ensemble(e, props))
         if show_in_progress:
             print("\tCurrently active tests:")
+            fmt = "{}={}".format
             for props in joshua_model.show_in_progress(e):
-                print(
-                    "\t{}".format(
-                        " ".join("{}={}".format(k, v) for k, v in sorted(props.items()))
-                    )
-                )
+                print("\t" + " ".join([fmt(k, v) for k, v in sorted(props.items())]))
 
     return ensemble_list
 
@@ -154,17 +254,12 @@ def stop_ensemble(ensemble=None, username=None, sanity=False, printable=True, **
         # Stop all active ensembles for the given username
         if not username:
             username = get_username()
-        if printable:
-            ensemble_list = (
-                joshua_model.list_sanity_ensembles()
-                if sanity
-                else joshua_model.list_active_ensembles()
-            )
-        else:
-            ensemble_list = get_active_ensembles(False, sanity, username)
+        ensemble_list = get_active_ensembles(False, sanity, username)
 
+        # IDs are YYYYmmdd-HHMMSS-username-hash.
+        owner_prefix = username + "-"
         for e, props in ensemble_list:
-            if "-" + username + "-" in str(e):
+            if str(e)[16:].startswith(owner_prefix):
                 if printable:
                     print("Stopping ensemble", e)
                 joshua_model.stop_ensemble(e, sanity)
@@ -172,15 +267,12 @@ def stop_ensemble(ensemble=None, username=None, sanity=False, printable=True, **
 
 def default_ensemble(sanity=False, **args):
     username = args.get("username") or get_username()
-    all_ensembles = [
-        e
-        for e, props in get_active_ensembles(True, False, False)
-        if props.get("username", None) == username
-        and props.get("sanity", False) == sanity
-    ]
-    if not all_ensembles:
-        raise Exception("No tests have ever run for username " + username)
-    return all_ensembles[-1]
+    # Ensembles are listed oldest first, so the newest match is the first one
+    # found walking backwards.
+    for e, props in reversed(get_active_ensembles(True, False, username)):
+        if props.get("sanity", False) == sanity:
+            return e
+    raise Exception("No tests have ever run for username " + username)
 
 
 def resume_ensemble(ensemble, sanity=False, **args):
@@ -209,8 +301,7 @@ def tail_ensemble(
     if not ensemble:
         if not username:
             username = args.get("username") or get_username()
-        ensembles = [e for e, props in get_active_ensembles(stopped, sanity, username)]
-        ensemble = ensembles[-1] if ensembles else None
+        ensemble = joshua_model.get_latest_active_ensemble(stopped, sanity, username)
         if not ensemble:
             sys.stderr.write("No active ensembles\n")
             return
@@ -219,41 +310,35 @@ def tail_ensemble(
     compressed = properties["compressed"] if "compressed" in properties else False
 
     sys.stderr.write("Results for test ensemble: %s\n" % ensemble)
+    # Raw and xml output bypass the text layer and go straight to the byte
+    # buffer. Someone watching a terminal sees every record as it arrives;
+    # otherwise records are only flushed in batches.
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    flush_every = 1 if out.isatty() else 256
+    write = out.write
+    flush = out.flush
+    get_unpacker = _UNPACKERS.get
+    emit_raw = raw or xml
     if xml:
-        sys.stdout.write("<Trace>")
-    for rec in joshua_model.tail_results(
-        ensemble, errors_only=errors_only, compressed=compressed
+        write(b"<Trace>")
+    for count, rec in enumerate(
+        joshua_model.tail_results(
+            ensemble, errors_only=errors_only, compressed=compressed
+        ),
+        1,
     ):
-        if len(rec) == 5:
-            versionstamp, result_code, host, seed, output = rec
-        elif len(rec) == 4:
-            versionstamp, result_code, host, output = rec
-            seed = None
-        elif len(rec) == 3:
-            versionstamp, result_code, output = rec
-            host = None
-            seed = None
-        elif len(rec) == 2:
-            versionstamp, seed = rec
-            output = str(joshua_model.fdb.tuple.unpack(seed)[0]) + "\n"
-            result_code = None
-            host = None
-            seed = None
-        else:
+        unpack = get_unpacker(len(rec))
+        if unpack is None:
             raise Exception("Unknown result format")
+        versionstamp, result_code, host, seed, output = unpack(rec)
 
         if simple:
             try:
-                doc = le.fromstring("<Dummy>" + output + "</Dummy>")
-                for elem in doc.xpath("//CodeCoverage"):
-                    elem.getparent().remove(elem)
-                for elem in doc.xpath("//BuggifySection"):
-                    elem.getparent().remove(elem)
-                for elem in doc.xpath('//*[(@Severity="30")]'):
-                    elem.getparent().remove(elem)
-                output = le.tostring(doc).decode("utf-8")[7:-8]
+                output = b"".join(_simplify_trace(output.encode("utf-8")))
                 parsed = True
             except Exception as e:
+                flush()
                 print(
                     "Could not parse xml output ({}) {} on {} because {}".format(
                         result_code, seed, host, e
@@ -261,13 +346,15 @@ def tail_ensemble(
                 )
                 raise
 
-        if raw or xml:
-            sys.stdout.write(output)
-            sys.stdout.flush()
+        if emit_raw:
+            write(output if isinstance(output, bytes) else output.encode("utf-8"))
+            if count % flush_every == 0:
+                flush()
         else:
             print(hex(versionstamp), result_code, host, seed, repr(output))
     if xml:
-        sys.stdout.write("</Trace>")
+        write(b"</Trace>")
+    flush()
     sys.stderr.write("Ensemble stopped\n")
 
 
@@ -287,12 +374,13 @@ def agent_failures(start=None, end=None, **args):
         print("No failures found in specified date range.")
 
     for failure in failures:
-        print("   ".join(failure[0]))
-        print(
-            "\n".join(
-                map(lambda x: (b"    " + x).decode("utf-8"), failure[1].split(b"\n"))
-            )
-        )  # This indents the the string for visual appealingness.
+        # Indent every line of the failure text for visual appealingness.
+        sys.stdout.write(
+            "   ".join(failure[0])
+            + "\n    "
+            + failure[1].replace(b"\n", b"\n    ").decode("utf-8")
+            + "\n"
+        )
 
 
 def _delete_helper(to_delete, yes=False, dryrun=False, sanity=False):
@@ -304,7 +392,7 @@ def _delete_helper(to_delete, yes=False, dryrun=False, sanity=False):
 
     if not yes and not dryrun:
         response = input("Do you want to delete these ensembles [y/n]? ")
-        if response.strip().lower() not in set(["y", "yes"]):
+        if response.strip().lower() not in _YES_RESPONSES:
             print("Negative response received. Not performing deletion.")
             return
 
@@ -355,12 +443,20 @@ def delete_ensemble_range(
     all_ensembles = joshua_model.list_all_ensembles()
     for ensemble, _ in all_ensembles:
         # Parse the date to see if the ensemble is within the given range.
+        # IDs start with a YYYYmmdd-HHMMSS stamp, so slice the fields out
+        # directly rather than going through strptime.
         try:
-            timestamp = time.mktime(
-                datetime.datetime.strptime(
-                    "".join(ensemble.split("-")[:2]), "%Y%m%d%H%M%S"
-                ).timetuple()
-            )
+            stamp = ensemble[:8] + ensemble[9:15]
+            if ensemble[8:9] != "-" or len(stamp) != 14 or not stamp.isdigit():
+                raise ValueError(ensemble)
+            timestamp = datetime.datetime(
+                int(stamp[0:4]),
+                int(stamp[4:6]),
+                int(stamp[6:8]),
+                int(stamp[8:10]),
+                int(stamp[10:12]),
+                int(stamp[12:14]),
+            ).timestamp()
             if (time_before is None or timestamp < time_before) and (
                 time_after is None or timestamp > time_after
             ):
@@ -396,7 +492,7 @@ def download_ensemble(ensemble, out=None, force=False, sanity=False, **args):
                 out_file
             )
         )
-        if resp.lower() != "y" and resp.lower() != "yes":
+        if resp.lower() not in _YES_RESPONSES:
             print("Not continuing")
             return
 
@@ -410,11 +506,29 @@ def download_ensemble(ensemble, out=None, force=False, sanity=False, **args):
         os.mkdir(ensemble_dir)
 
     print("Downloading ensemble {} into {}...".format(ensemble, out_file))
-    with open(out_file, "wb") as fout:
+    # Blob parts arrive 128 KiB at a time; a larger buffer batches several of
+    # them into each write.
+    with open(out_file, "wb", buffering=1 << 20) as fout:
         joshua_model.get_ensemble_data(ensemble_id=ensemble, outfile=fout)
     print("Download completed")
 
 
+# Blocking ctypes calls into the FDB client don't return to the interpreter,
+# so KeyboardInterrupt would never be raised while waiting on them. Exit
+# straight from the signal handler instead. os._exit skips the interpreter's
+# own flushing, and tail_ensemble batches its writes when stdout is not a
+# terminal, so flush what has already been written first.
+def _exit_on_interrupt(signum, frame):
+    for stream in (sys.stdout, sys.stdout.buffer):
+        try:
+            stream.flush()
+        except (OSError, RuntimeError, ValueError):
+            # A closed pipe, or the signal arrived in the middle of a write
+            # to the same stream (reentrant call).
+            pass
+    os._exit(130)
+
+
 if __name__ == "__main__":
     name_space = os.environ.get("JOSHUA_NAMESPACE", "joshua")
     parser = argparse.ArgumentParser(description="How about a nice game of chess?")
@@ -707,10 +821,5 @@ if __name__ == "__main__":
         exit(-1)
 
     joshua_model.open(arguments.cluster_file, dir_path=arguments.dir_path)
-    # Running everything (esp ctypes blocking calls) in a thread
-    # makes the program much more responsive to KeyboardInterrupt
-    t = threading.Thread(target=arguments.cmd, args=(), kwargs=vars(arguments))
-    t.daemon = True
-    t.start()
-    while t.is_alive():
-        t.join(6000)
+    signal.signal(signal.SIGINT, _exit_on_interrupt)
+    arguments.cmd(**vars(arguments))
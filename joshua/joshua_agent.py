@@ -19,41 +19,56 @@
 #
 
 import argparse
+import bisect
+import contextlib
+import ctypes
 import errno
+import functools
+import itertools
 import os
 import queue
 import random
-import re
+import selectors
 import shutil
+import signal
 import sys
 import tarfile
-import tempfile
 import threading
 import time
 import traceback
-import datetime
+from collections import deque
 from pprint import pprint
 
 # this is used to read / patch Pod labels
 from kubernetes import client, config
 
 import subprocess32 as subprocess
-import fdb
 from . import joshua_model
 from . import process_handling
 
 try:
-    import childsubreaper
+    from isal import igzip_threaded
 except ImportError:
-    print(
-        "Unable to import module childsubreaper. Orphaned grandchildren will re-parent to init."
-    )
+    # Artifacts are compressed with the standard library's gzip instead.
+    igzip_threaded = None
 
 # basepath = os.getcwd()
-mutex = threading.Lock()
 job_mutex = threading.Lock()
 threadlocal = threading.local()
-job_queue = queue.Queue()
+# Recent job results as (retcode, completion time in epoch ms), oldest first.
+# deque appends and pops are atomic, so producers need no lock, and maxlen
+# keeps the history bounded even if nothing ever calls trim_jobqueue.
+JOB_QUEUE_LIMIT = 1 << 16
+job_queue = deque(maxlen=JOB_QUEUE_LIMIT)
+# How long the agent may reuse ensemble weights before re-reading them.
+ENSEMBLE_WEIGHTS_MAX_AGE = 300
+# Directories are renamed aside with this marker in their name and deleted by a
+# background reaper thread, so the agent only pays for the rename.
+GARBAGE_MARKER = ".garbage."
+_reaper_queue = queue.Queue(maxsize=64)
+_reaper_lock = threading.Lock()
+_reaper_thread = None
+_garbage_counter = itertools.count()
 jobs_pass = 0
 jobs_fail = 0
 stop_agent = False
@@ -71,39 +86,6 @@ class JoshuaError(Exception):
         return "JoshuaError(" + repr(self.msg) + ")"
 
 
-# This is used to handle waiting for a given amount of time.
-class TimeoutFuture(object):
-    def __init__(self, timeout):
-        self.cb_list = []
-        self.timer = threading.Timer(timeout, self._do_on_ready)
-        self.fired = False
-        self.timer.start()
-
-    def _do_on_ready(self):
-        # Update the state synchronously.
-        mutex.acquire()
-        self.fired = True
-        mutex.release()
-
-        # Call all callbacks.
-        for cb in self.cb_list:
-            cb(None)
-
-    def on_ready(self, callback):
-        # Acquire a lock so that self.fired isn't changed in the middle
-        # of this operation.
-        mutex.acquire()
-
-        if not self.fired:
-            # Not fired yet. Add the element to the list, then release our lock.
-            self.cb_list.append(callback)
-            mutex.release()
-        else:
-            # Already fired. Call the callback immediately after releasing the lock.
-            mutex.release()
-            callback()
-
-
 def getFileHandle():
     output_fd = getattr(threadlocal, "output_fd", None)
     return output_fd if output_fd else sys.stdout
@@ -118,13 +100,12 @@ def trim_jobqueue(cutoff_date, remove_jobs=True):
     global job_queue
     jobs_pass = 0
     jobs_fail = 0
-    cutoff_string = joshua_model.format_datetime(cutoff_date)
+    cutoff_ms = int(cutoff_date.timestamp() * 1000)
 
-    for job_record in list(job_queue.queue):
-        (result, job_date) = fdb.tuple.unpack(job_record)
-        if job_date <= cutoff_string:
+    for (result, job_ms) in list(job_queue):
+        if job_ms <= cutoff_ms:
             if remove_jobs:
-                old_record = job_queue.get_nowait()
+                job_queue.popleft()
         elif result == 0:
             jobs_pass += 1
         else:
@@ -154,6 +135,9 @@ def agent_init(work_dir):
     return True
 
 
+_SAN_TABLE = str.maketrans({"/": "-"})
+
+
 def sanitize_for_file_name(name):
     """
     >>> sanitize_for_file_name('joshua')
@@ -161,7 +145,19 @@ def sanitize_for_file_name(name):
     >>> sanitize_for_file_name('joshua/joshua')
     'joshua-joshua'
     """
-    return "".join(a if a != "/" else "-" for a in name)
+    return name.translate(_SAN_TABLE)
+
+
+# The property names and env= settings barely vary between jobs, but the
+# properties as a whole do (they carry the run counters), so cache the pieces.
+@functools.lru_cache(maxsize=256)
+def _joshua_env_name(key):
+    return "JOSHUA_" + key.upper()
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_env_setting(setting):
+    return tuple(tuple(x.split("=", 1)) for x in setting.split(":"))
 
 
 def ensemble_dir(ensemble_id=None, basepath=None):
@@ -182,12 +178,29 @@ def ensemble_dir(ensemble_id=None, basepath=None):
 
 
 def check_archive_path(name):
-    path = os.path.normpath(name)
-    if path.startswith("/"):
-        return False
-    if path.startswith(".."):
-        return False
-    return True
+    """
+    Rejects absolute member names and any that climb out with a ".." component.
+    This is stricter than normalizing first, but avoids normpath per member.
+
+    >>> check_archive_path('joshua_test')
+    True
+    >>> check_archive_path('bin/..data')
+    True
+    >>> check_archive_path('/etc/passwd')
+    False
+    >>> check_archive_path('../joshua_test')
+    False
+    >>> check_archive_path('bin/../../joshua_test')
+    False
+    >>> check_archive_path('bin/..')
+    False
+    """
+    return not (
+        name.startswith(("/", "../"))
+        or name == ".."
+        or "/../" in name
+        or name.endswith("/..")
+    )
 
 
 def ensure_state_test_delay():
@@ -216,16 +229,40 @@ def ensure_state(ensemble_id, where, properties, basepath=None):
     tmpdir = where + ".part"
     os.mkdir(tmpdir)
 
-    with tempfile.SpooledTemporaryFile(max_size=200e6) as temp_file:
-        joshua_model.get_ensemble_data(ensemble_id, temp_file)
-        temp_file.seek(0)
-        tarf = tarfile.open(fileobj=temp_file)
+    # Stream the tarball from the database straight into tarfile through a
+    # pipe, so fetching, decompressing and extracting overlap and the archive
+    # is never staged in memory or on disk.
+    read_fd, write_fd = os.pipe()
+    fetch_errors = []
 
-        members = tarf.getmembers()
-        tarf.extractall(
-            path=tmpdir,
-            members=[m for m in tarf.getmembers() if check_archive_path(m.name)],
-        )
+    def fetch():
+        try:
+            with os.fdopen(write_fd, "wb") as pipe_out:
+                joshua_model.get_ensemble_data(ensemble_id, pipe_out)
+        except BrokenPipeError:
+            # The reader stopped early and will report why.
+            pass
+        except Exception as e:
+            fetch_errors.append(e)
+
+    fetcher = threading.Thread(target=fetch)
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        with os.fdopen(read_fd, "rb") as pipe_in:
+            with tarfile.open(fileobj=pipe_in, mode="r|*") as tarf:
+                tarf.extractall(
+                    path=tmpdir,
+                    members=(m for m in tarf if check_archive_path(m.name)),
+                )
+            # Drain any padding after the end-of-archive marker so the fetcher
+            # can finish writing.
+            while pipe_in.read(1 << 16):
+                pass
+    finally:
+        fetcher.join()
+        if fetch_errors:
+            raise fetch_errors[0]
 
     os.symlink(
         os.path.join(basepath, "global_data"), os.path.join(tmpdir, "global_data")
@@ -249,6 +286,21 @@ def ensure_state(ensemble_id, where, properties, basepath=None):
     return True
 
 
+# Opens a .tar.gz for writing. When python-isal is available the tar stream
+# is compressed on a pool of worker threads with ISA-L instead of zlib.
+@contextlib.contextmanager
+def _open_artifact_tar(path):
+    if igzip_threaded is None:
+        with tarfile.open(path, mode="w:gz", compresslevel=1) as tarf:
+            yield tarf
+        return
+
+    threads = max(1, (os.cpu_count() or 1) // 2)
+    with igzip_threaded.open(path, "wb", compresslevel=1, threads=threads) as gz:
+        with tarfile.open(fileobj=gz, mode="w|") as tarf:
+            yield tarf
+
+
 # Tars and gzips the contents of the sources together in a file in dest.
 
 
@@ -261,41 +313,97 @@ def tar_artifacts(ensemble, seed, sources, dest, work_dir=None):
             + os.getenv("PATH")
             + ")"
         )
+    out_name = "joshua-run-{0}-{1}".format(sanitize_for_file_name(ensemble), seed)
+    out_file = os.path.join(dest, out_name + ".tar.gz")
+    part_file = out_file + ".part"
     try:
-        # Create a temporary directory in the destination where we will store the results.
-        out_name = "joshua-run-{0}-{1}".format(ensemble, seed)
-        tmpdir = os.path.join(work_dir, out_name)
-        os.makedirs(tmpdir)
-
-        for source in sources:
-            # Verify that the file exists.
-            if os.path.exists(source):
-                if os.path.isdir(source):
-                    shutil.copytree(
-                        source, os.path.join(tmpdir, os.path.basename(source))
+        os.makedirs(dest, exist_ok=True)
+
+        # Add each source straight into the archive under out_name/ rather than
+        # copying everything aside first. Cores barely compress, so trade ratio
+        # for speed.
+        with _open_artifact_tar(part_file) as tarf:
+            for source in sources:
+                # Verify that the file exists.
+                if os.path.exists(source):
+                    tarf.add(
+                        source, arcname=os.path.join(out_name, os.path.basename(source))
                     )
-                else:
-                    shutil.copy(source, tmpdir)
 
-        # Tar and gzip the copied files.
-        with open(tmpdir + ".tar.gz", "wb") as tar_file_obj:
-            tarf = tarfile.open(fileobj=tar_file_obj, mode="w:gz")
-            tarf.add(tmpdir, arcname=os.path.basename(tmpdir))
-            tarf.close()
-
-        # Copy the .tar.gz file to its final destination.
-        shutil.move(tmpdir + ".tar.gz", dest)
-
-        shutil.rmtree(tmpdir)
+        # Only expose the archive once it is complete.
+        os.rename(part_file, out_file)
     except Exception as e:
         # Non-critical if this fails. Just print the error and move on.
         log(e)
+        try:
+            os.unlink(part_file)
+        except OSError:
+            pass
+
+
+def _reap_garbage():
+    while True:
+        reap, path = _reaper_queue.get()
+        reap(path)
+
+
+def _remove_tree(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+# Deletes what an agent that was killed renamed aside but never reaped:
+# discarded ensembles directly under root, and discarded tmp directories
+# inside the ensembles that remain.
+def _sweep_garbage(root):
+    try:
+        with os.scandir(root) as entries:
+            ensembles = list(entries)
+    except OSError:
+        return
+    for entry in ensembles:
+        if GARBAGE_MARKER in entry.name:
+            _remove_tree(entry.path)
+        elif entry.is_dir(follow_symlinks=False):
+            try:
+                with os.scandir(entry.path) as entries:
+                    garbage = [e.path for e in entries if GARBAGE_MARKER in e.name]
+            except OSError:
+                continue
+            for path in garbage:
+                _remove_tree(path)
+
+
+def _queue_for_reaping(path, reap=_remove_tree):
+    global _reaper_thread
+    with _reaper_lock:
+        if _reaper_thread is None:
+            _reaper_thread = threading.Thread(
+                target=_reap_garbage, name="reaper", daemon=True
+            )
+            _reaper_thread.start()
+    # Blocks if the reaper falls far behind, which bounds the garbage on disk.
+    _reaper_queue.put((reap, path))
+
+
+# Starts the reaper on an agent's ensembles directory. Its first job is to
+# finish deleting whatever a previous agent left behind there.
+def start_reaper(root):
+    _queue_for_reaping(root, _sweep_garbage)
+
+
+# Renames the directory aside and leaves the deletion to the reaper thread.
+def discard_directory(path):
+    garbage = "{}{}{}.{}".format(
+        path, GARBAGE_MARKER, os.getpid(), next(_garbage_counter)
+    )
+    os.rename(path, garbage)
+    _queue_for_reaping(garbage)
 
 
 # Clear a directory without removing it. (i.e., "rm -rf path/*" rather than "rm -rf path")
 def clear_directory(path):
     try:
-        shutil.rmtree(path)
+        discard_directory(path)
         os.mkdir(path)
     except Exception as e:
         # Non-critical if this fails. Just print the error and move on.
@@ -312,24 +420,38 @@ def find_cores(work_dir=None):
             + os.getenv("PATH")
             + ")"
         )
-    cores = []
-    core_pattern = re.compile(r"^core\..*$")
+    return _walk_cores(work_dir)
 
-    for root, dirs, files in os.walk(work_dir):
-        for file in files:
-            if core_pattern.match(file) is not None:
-                cores.append(os.path.join(root, file))
 
-    return cores
+# Walk the tree with scandir, which hands back each entry's type along with
+# its name. Like os.walk, don't descend into symlinked directories and skip
+# directories that can't be read.
+def _walk_cores(work_dir):
+    pending = [work_dir]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        pending.append(entry.path)
+                elif entry.name.startswith("core."):
+                    yield entry.path
 
 
 # Removes all of the artifacts that are older than a certain limit.
 # The default age to check is 24 hours.
 def remove_old_artifacts(path, age=24 * 60 * 60):
-    for artifact in list(os.listdir(path)):
+    cutoff = time.time() - age
+    with os.scandir(path) as entries:
+        artifacts = list(entries)
+    for artifact in artifacts:
         try:
-            if time.time() - os.path.getmtime(os.path.join(path, artifact)) >= age:
-                os.unlink(os.path.join(path, artifact))
+            if artifact.stat().st_mtime <= cutoff:
+                os.unlink(artifact.path)
         except Exception as e:
             # Non-critical. Print an error message and move on.
             log(e)
@@ -351,7 +473,7 @@ def cleanup(ensemble, where, seed, retcode=0, save_on="FAILURE", work_dir=None):
             + ")"
         )
     # Save the results of the operation if we are supposed to do so.
-    core_files = find_cores(work_dir=work_dir)
+    core_files = list(find_cores(work_dir=work_dir))
     if should_save(retcode, save_on):
         tar_artifacts(
             ensemble,
@@ -366,37 +488,88 @@ def cleanup(ensemble, where, seed, retcode=0, save_on="FAILURE", work_dir=None):
         os.unlink(core_file)
 
     killing_error = None
+    try:
+        # Now that the process has ended, kill any child processes that it has
+        # spawned. This waits for them to die, and sweeps again for any that
+        # were forked while the others were being killed.
+        process_handling.kill_all_children()
+    except Exception as e:
+        killing_error = e
 
-    # Do this up to 10 times to handle processes that take longer than we would like to shutdown.
-    problem_killing = False
-    for i in range(10):
-        problem_killing = False
-
-        try:
-            # Now that the process has ended, kill any child processes that it has
-            # spawned.
-            process_handling.kill_all_children()
-        except Exception as e:
-            problem_killing = True
-            killing_error = e
-
-        if not problem_killing:
-            break
+    # Collect anything the test orphaned that has since exited on its own.
+    # This only happens here, between jobs, when no other thread of the
+    # agent is waiting on a process it started.
+    process_handling.reap_orphans()
 
     getFileHandle().write("\n")
 
     # Something abnormal happened. Raise to restart machine.
-    if problem_killing:
-        if killing_error is None:
-            raise JoshuaError(
-                "Could not kill main process in a reasonable amount of time."
-            )
-        else:
-            raise killing_error
+    if killing_error is not None:
+        raise killing_error
 
     # Clear the temporary directory.
     clear_directory(os.path.join(where, "tmp"))
 
+
+# Inserts finished results into the database from a background thread.
+# Submitted results don't count as ended yet, so callers must flush() before
+# try_starting_test().
+class ResultsWriter:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._error = None
+
+    def submit(self, ensemble, seed, retcode, output, *args):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="results-writer", daemon=True
+                )
+                self._thread.start()
+        self._queue.put((ensemble, seed, retcode, output) + args)
+
+    # Waits until every submitted result has been written, then raises the
+    # first error any of those writes hit.
+    def flush(self):
+        self._queue.join()
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while True:
+            result = self._queue.get()
+            try:
+                self._write(*result)
+            except Exception as e:
+                log("Unable to insert results: {}".format(e))
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(ensemble, seed, retcode, output, *args):
+        try:
+            joshua_model.insert_results(ensemble, seed, retcode, output, *args)
+        except joshua_model.FDBError as e:
+            # Since insert_results is wrapped by the @fdb.transactional, e is non-retryable.
+            joshua_model.insert_results(
+                ensemble,
+                seed,
+                e.code,
+                joshua_model.wrap_error(e.description),
+                *args
+            )
+
+
+results_writer = ResultsWriter()
+
+
 class AsyncDone:
     def __init__(self):
         self._lock = threading.Lock()
@@ -415,7 +588,7 @@ class AsyncDone:
         if not os.path.exists(cmd_path):
             log("{} doesn't exist".format(cmd_path))
             return
-        process = subprocess.Popen(
+        process = process_handling.popen(
             command,
             cwd=cwd,
             env=env
@@ -507,15 +680,14 @@ class AsyncEnsemble:
         # Copy any env=NAME1=VALUE:NAME2=VALUE into the environment
         # We do this first so that it can't overwrite anything below.
         if "env" in properties and properties["env"]:
-            env_settings = [x.split("=", 1) for x in properties["env"].split(":")]
-            for k, v in env_settings:
+            for k, v in _parse_env_setting(properties["env"]):
                 env[k] = v
-        for k, v in properties.items():
-            if k == "env":
-                continue
-            env["JOSHUA_" + k.upper()] = str(v)
+        env.update(
+            (_joshua_env_name(k), str(v)) for k, v in properties.items() if k != "env"
+        )
         env["JOSHUA_SEED"] = str(seed).rstrip("L")
-        env['JOSHUA_APP_DIR'] = ",".join(list(joshua_model.get_application_dir(ensemble)))
+        app_dir = ",".join(joshua_model.get_application_dir(ensemble))
+        env['JOSHUA_APP_DIR'] = app_dir
         if joshua_model.cluster_file is not None:
             env['JOSHUA_CLUSTER_FILE'] = joshua_model.cluster_file
         # process_handling.ensure_path(env)
@@ -552,12 +724,13 @@ class AsyncEnsemble:
         ensure_state(ensemble, where, properties, basepath=work_dir)
 
         # Set environment variable to use the created temporary directory as its temporary directory.
-        env["TMP"] = os.path.join(where, "tmp")
+        tmp_dir = os.path.join(where, "tmp")
+        env["TMP"] = tmp_dir
 
         log("{} {} {}".format(ensemble, seed, command))
 
         # Run the test and log output
-        process = subprocess.Popen(
+        process = process_handling.popen(
             command,
             cwd=where,
             env=env,
@@ -572,36 +745,59 @@ class AsyncEnsemble:
         output = b""
         retcode = 0
 
-        while True:
-            getFileHandle().flush()
-            try:
-                output, _ = process.communicate(timeout=1)
-                retcode = process.poll()
-                log("exit code: {}".format(retcode))
-                # output = output.decode('utf-8')
+        # Collect stdout until both pipes close and the test exits, sleeping
+        # in select() rather than cycling communicate() threads. stderr is
+        # drained but discarded. Cancellation and the timeout are checked
+        # (and progress printed) at most once a second.
+        output_buf = bytearray()
+        last_tick = start_time
+        with selectors.DefaultSelector() as sel:
+            sel.register(process.stdout, selectors.EVENT_READ)
+            sel.register(process.stderr, selectors.EVENT_READ)
+            while True:
+                if sel.get_map():
+                    for key, _ in sel.select(timeout=1):
+                        chunk = os.read(key.fd, 65536)
+                        if not chunk:
+                            sel.unregister(key.fileobj)
+                        elif key.fileobj is process.stdout:
+                            output_buf += chunk
+                else:
+                    try:
+                        process.wait(timeout=1)
+                    except subprocess.TimeoutExpired:
+                        pass
+                if not sel.get_map() and process.poll() is not None:
+                    retcode = process.returncode
+                    # FDB only accepts bytes values.
+                    output = bytes(output_buf)
+                    log("exit code: {}".format(retcode))
+                    break
 
-                break
-            except subprocess.TimeoutExpired:
+                now = time.time()
+                if now - last_tick < 1:
+                    continue
+                last_tick = now
                 if self._cancelled():
                     log("<cancelled>")
                     retcode = -1
-                    output = b""
                     break
-                if timeout_time and time.time() > timeout_time:
+                if timeout_time and now > timeout_time:
                     log("<timed out>")
                     retcode = -2
-                    output = b""
                     break
                 getFileHandle().write(".")
+                getFileHandle().flush()
 
         duration = max(1, time.time() - start_time)
-        done_timestamp = joshua_model.format_datetime(datetime.datetime.now(datetime.timezone.utc))
+        done_ms = int(time.time() * 1000)
 
         if retcode == -2 and time.time() > timeout_time:
             if os.path.isfile(os.path.join(where, timeout_command)):
                 log("Summarizing timeout...")
+                process = None
                 try:
-                    process = subprocess.Popen(
+                    process = process_handling.popen(
                         timeout_command,
                         cwd=where,
                         env=env,
@@ -613,6 +809,13 @@ class AsyncEnsemble:
                     log("done")
                 except Exception as e:
                     log("failed")
+                    # Don't leave a hung timeout command behind. Its children
+                    # are killed with the rest in cleanup().
+                    if process is not None and process.poll() is None:
+                        process.kill()
+                        process.wait()
+                        process.stdout.close()
+                        process.stderr.close()
                     output = joshua_model.wrap_message(
                         {
                             "Error": "JoshuaTimeout",
@@ -638,11 +841,11 @@ class AsyncEnsemble:
 
         # Write the output to the tmp directory so that it is picked up when we save (if we do so).
         del_output_file = not should_save(retcode, save_on)
-        to_write = os.path.join(where, "tmp", "console.log")
+        to_write = os.path.join(tmp_dir, "console.log")
         try:
             i = 0
             while os.path.exists(to_write):
-                to_write = os.path.join(where, "tmp", "console-{0}.log".format(i))
+                to_write = os.path.join(tmp_dir, "console-{0}.log".format(i))
                 i += 1
 
             with open(to_write, "wb") as fout:
@@ -656,7 +859,7 @@ class AsyncEnsemble:
 
         done_args = [done_command,
                      ensemble,
-                     ",".join(list(joshua_model.get_application_dir(ensemble))),
+                     app_dir,
                      str(seed),
                      str(retcode),
                      os.path.abspath(to_write)]
@@ -676,42 +879,27 @@ class AsyncEnsemble:
 
         cleanup(ensemble, where, seed, retcode, save_on, work_dir=work_dir)
 
-        try:
-            joshua_model.insert_results(
-                ensemble,
-                seed,
-                retcode,
-                output,
-                compressed,
-                sanity,
-                fail_fast,
-                max_runs,
-                duration,
-            )
-        except joshua_model.FDBError as e:
-            # Since insert_results is wrapped by the @fdb.transactional, e is non-retryable.
-            joshua_model.insert_results(
-                ensemble,
-                seed,
-                e.code,
-                bytes(joshua_model.wrap_error(e.description), encoding="utf-8"),
-                compressed,
-                sanity,
-                fail_fast,
-                max_runs,
-                duration,
-            )
+        results_writer.submit(
+            ensemble,
+            seed,
+            retcode,
+            output,
+            compressed,
+            sanity,
+            fail_fast,
+            max_runs,
+            duration,
+        )
 
         # Add the result to the job queue
-        job_queue.put(fdb.tuple.pack((retcode, done_timestamp)))
+        job_queue.append((retcode, done_ms))
 
         # Update the job counts
-        job_mutex.acquire()
-        if retcode == 0:
-            jobs_pass += 1
-        else:
-            jobs_fail += 1
-        job_mutex.release()
+        with job_mutex:
+            if retcode == 0:
+                jobs_pass += 1
+            else:
+                jobs_fail += 1
 
         self._retcode = retcode
 
@@ -721,6 +909,8 @@ def run_ensemble(
 ):
     seed = random.getrandbits(63)
 
+    # The previous run's result must be counted before this one can start.
+    results_writer.flush()
     if not joshua_model.try_starting_test(ensemble, seed, sanity):
         log("<job stopped>")
         return -3
@@ -776,6 +966,7 @@ def agent(
         threadlocal.output_fd = open(log_file, "w+")
     # Make sure "ensembles" directory exists.
     os.makedirs(ensemble_dir(basepath=work_dir), mode=0o755, exist_ok=True)
+    start_reaper(ensemble_dir(basepath=work_dir))
 
     start = time.time()  # Used later to limit time agent runs.
     idle_start = start  # Used to determine idle duration
@@ -805,6 +996,13 @@ def agent(
         watch = None
         sanity_watch = None
 
+        # Weights for picking among the runnable ensembles, and what they were
+        # computed for.
+        buckets = None
+        buckets_cum = None
+        buckets_key = None
+        buckets_time = 0.0
+
         while True:
             # Break if the stop file is defined and present
             if stop_file and os.path.exists(stop_file):
@@ -883,12 +1081,18 @@ def agent(
             # remove_old_artifacts(os.path.join(basepath, 'runs'))
 
             # Throw away local state for ensembles that are no longer active
-            local_ensemble_dirs = set(os.listdir(ensemble_dir(basepath=work_dir)))
+            local_ensemble_dirs = {
+                name
+                for name in os.listdir(ensemble_dir(basepath=work_dir))
+                if GARBAGE_MARKER not in name
+            }
             for e in (local_ensemble_dirs - set(ensembles)) - set(sanity_ensembles):
                 log("removing {} {}".format(e, ensemble_dir(e, basepath=work_dir)))
-                shutil.rmtree(
-                    ensemble_dir(e, basepath=work_dir), True
-                )  # SOMEDAY: this sometimes throws errors, but we don't know why and it isn't that important
+                try:
+                    discard_directory(ensemble_dir(e, basepath=work_dir))
+                except OSError as err:
+                    # Not important; the next pass will try again.
+                    log(err)
 
             ensembles_can_run = None
             if ensembles:
@@ -904,7 +1108,7 @@ def agent(
             else:
                 # No ensembles at all. Consider timing this agent out.
                 try:
-                    watch.wait_for_any(watch, sanity_watch, TimeoutFuture(1.0))
+                    joshua_model.wait_for_any(watch, sanity_watch, timeout=1.0)
                 except Exception as e:
                     log("watch error: {}".format(e))
                     watch = None
@@ -926,19 +1130,25 @@ def agent(
             # Pick an ensemble to run. Weight by amount of time spent on each one.
 
             #            print('{} Picking from {} ensembles'.format(threading.current_thread().name, len(ensembles)))
-            durations = joshua_model.get_ensemble_mean_durations(ensembles_can_run)
-            priorities = joshua_model.get_ensemble_priorities(ensembles_can_run)
-            buckets = [(en, priorities[en] / durations[en]) for en in ensembles_can_run]
-            choice = random.random() * sum([width for _, width in buckets])
-            chosen_ensemble = None
-            so_far = 0.0
+            # Mean durations only drift as results come in, so the weights are
+            # reused while the ensemble list and the runnable subset are
+            # unchanged, and refreshed once they get too old.
+            key = (watch, tuple(ensembles_can_run))
+            now = time.time()
+            if key != buckets_key or now - buckets_time >= ENSEMBLE_WEIGHTS_MAX_AGE:
+                weights = joshua_model.get_ensemble_priorities_and_durations(
+                    ensembles_can_run
+                )
+                buckets = [
+                    (en, weights[en][0] / weights[en][1]) for en in ensembles_can_run
+                ]
+                buckets_cum = list(itertools.accumulate(width for _, width in buckets))
+                buckets_key = key
+                buckets_time = now
+            # The first bucket whose running total reaches the choice wins.
+            choice = random.random() * buckets_cum[-1]
             #            print('{} Running {} ensembles'.format(threading.current_thread().name, len(buckets)))
-            for ensemble, width in buckets:
-                so_far += width
-                if so_far >= choice:
-                    chosen_ensemble = ensemble
-                    break
-            assert chosen_ensemble is not None
+            chosen_ensemble = buckets[bisect.bisect_left(buckets_cum, choice)][0]
             retcode = run_ensemble(
                 chosen_ensemble,
                 save_on,
@@ -976,22 +1186,39 @@ def agent(
             # if zombies:
             #    print('\n'.join(zombies))
             #    raise JoshuaError('Zombie process (' + str(zombies) + ') present (after end)!')
+
+        results_writer.flush()
     except:
         joshua_model.log_agent_failure(traceback.format_exc())
+        # Don't lose results that were already handed to the writer.
+        with contextlib.suppress(Exception):
+            results_writer.flush()
         raise
 
 
+# prctl() option that makes orphaned descendants re-parent to this process.
+PR_SET_CHILD_SUBREAPER = 36
+
+
 def reap_children():
     # Call prctl(PR_SET_CHILD_SUBREAPER) so that grandchildren re-parent to this process instead of init.
-    if "childsubreaper" in dir():
-        retcode = childsubreaper.set_child_subreaper()
+    if not sys.platform.startswith("linux"):
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    retcode = libc.prctl(
+        PR_SET_CHILD_SUBREAPER,
+        ctypes.c_ulong(1),
+        ctypes.c_ulong(0),
+        ctypes.c_ulong(0),
+        ctypes.c_ulong(0),
+    )
 
-        if retcode != 0:
-            print(
-                "Call prctl(PR_SET_CHILD_SUBREAPER) returned non-zero error code ",
-                retcode,
-            )
-            print("Orphaned grandchildren may re-parent to init.")
+    if retcode != 0:
+        print(
+            "Call prctl(PR_SET_CHILD_SUBREAPER) failed: ",
+            os.strerror(ctypes.get_errno()),
+        )
+        print("Orphaned grandchildren may re-parent to init.")
 
 
 if __name__ == "__main__":
@@ -1077,21 +1304,24 @@ if __name__ == "__main__":
     joshua_model.open(arguments.cluster_file, arguments.dir_path)
     agent_init(arguments.work_dir)
 
-    # Running everything (esp ctypes blocking calls) in a thread makes the program much more responsive to KeyboardInterrupt
-    t = threading.Thread(
-        target=agent,
-        args=(),
-        kwargs={
-            "agent_timeout": agent_timeout,
-            "save_on": arguments.save_on,
-            "sanity_period": arguments.sanity_period,
-            "agent_idle_timeout": arguments.agent_idle_timeout,
-            "timeout_command_timeout": arguments.timeout_command_timeout,
-            "stop_file": arguments.stop_file,
-            "work_dir": arguments.work_dir,
-        },
+    # The agent only blocks in interruptible waits of a second or less, so it
+    # can run on the main thread. The first SIGINT or SIGTERM lets the current
+    # test finish and its results be written; a second one kills the agent
+    # outright. The handler may interrupt a write to stdout, so it must not
+    # do any I/O itself.
+    def request_stop(signum, frame):
+        global stop_agent
+        stop_agent = True
+        signal.signal(signum, signal.SIG_DFL)
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    agent(
+        agent_timeout=agent_timeout,
+        save_on=arguments.save_on,
+        sanity_period=arguments.sanity_period,
+        agent_idle_timeout=arguments.agent_idle_timeout,
+        timeout_command_timeout=arguments.timeout_command_timeout,
+        stop_file=arguments.stop_file,
+        work_dir=arguments.work_dir,
     )
-    t.daemon = True
-    t.start()
-    while t.is_alive():
-        t.join(6000)
@@ -18,22 +18,24 @@
 # limitations under the License.
 #
 
+import concurrent.futures
 import datetime
+import functools
 import hashlib
 import heapq
 import logging
 import os
-import random
-import re
 import socket
 import struct
 import sys
+import threading
 import time
 import traceback
 import xml.etree.ElementTree as ET
 import zlib
 import boto3
 from collections import defaultdict
+from collections import deque
 from io import BytesIO
 from typing import Dict
 from typing import List
@@ -50,21 +52,30 @@ logger.setLevel(logging.DEBUG)
 fdb.api_version(630)
 FDBError = fdb.FDBError
 
-ONE = b"\x01" + b"\x00" * 7
+# Little-endian encoders for the counters (atomic adds) and for the offset
+# suffix of versionstamped keys.
+_U64LE = struct.Struct("<Q")
+_U32LE = struct.Struct("<I")
+ONE = _U64LE.pack(1)
+MINUS_ONE = struct.pack("<q", -1)
 TIMESTAMP_FMT = "%Y%m%d-%H%M%S"
 
-TIMEDELTA_REGEX1 = re.compile(
-    r"(?P<days>[-\d]+) day[s]*, (?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d[\.\d+]*)"
-)
-TIMEDELTA_REGEX2 = re.compile(
-    r"(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d[\.\d+]*)"
-)
-
 # A random instance ID as the seed for Joshua agent
 instanceid = os.urandom(8)
 
 BLOB_KEY_LIMIT = 8192
 BLOB_TRANSACTION_LIMIT = 128 * 1024
+# How much of a blob _insert_blob writes per transaction, and how many of
+# those transactions it keeps in flight at once. A part plus its keys stays
+# well under FDB's recommended 1 MB per transaction.
+BLOB_COMMIT_BYTES = 512 * 1024
+BLOB_UPLOAD_CONCURRENCY = 4
+# How many BLOB_TRANSACTION_LIMIT reads _read_blob keeps in flight at once.
+BLOB_DOWNLOAD_CONCURRENCY = 8
+# How many blob-backed results tail_results fetches ahead of the consumer.
+TAIL_BLOB_PREFETCH = 4
+# How many ensembles get_latest_active_ensemble checks the owner of at once.
+LATEST_ENSEMBLE_BATCH = 100
 
 INSTANCE_ID_ENV_VAR = "PLATFORM_SHORT_INSTANCE_ID"
 OLD_INSTANCE_ID_ENV_VAR = "SHORT_TASK_ID"
@@ -136,7 +147,9 @@ def get_dir_changes(sanity=False):
 
 def get_hash(file):
     hash = hashlib.sha256()
-    hash.update(file.read())
+    # Hash in blocks rather than reading the whole tarball into memory.
+    for block in iter(lambda: file.read(1 << 20), b""):
+        hash.update(block)
     file.seek(0)
     return hash.hexdigest()
 
@@ -151,20 +164,48 @@ def transactional(func):
     return helper
 
 
+# The same escaping ElementTree applies to attribute values, so that messages
+# come out byte-for-byte as they did when they were built with it.
+_XML_ATTRIB_ESCAPES = str.maketrans(
+    {
+        "&": "&amp;",
+        "<": "&lt;",
+        ">": "&gt;",
+        '"': "&quot;",
+        "\r": "&#13;",
+        "\n": "&#10;",
+        "\t": "&#09;",
+    }
+)
+
+
+def _wrap(tag, attribs):
+    return "<Test><{} {} /></Test>\n".format(
+        tag,
+        " ".join(
+            '{}="{}"'.format(k, v.translate(_XML_ATTRIB_ESCAPES))
+            for k, v in attribs.items()
+        ),
+    ).encode("ascii", "xmlcharrefreplace")
+
+
+_ERROR_TEMPLATE = '<Test><JoshuaError Severity="40" ErrorMessage="{}" /></Test>\n'
+
+
 def wrap_error(description):
-    root = ET.Element("Test")
-    ET.SubElement(root, "JoshuaError", {"Severity": "40", "ErrorMessage": description})
-    return ET.tostring(root) + b"\n"
+    return _ERROR_TEMPLATE.format(description.translate(_XML_ATTRIB_ESCAPES)).encode(
+        "ascii", "xmlcharrefreplace"
+    )
 
 
 def wrap_message(info={}):
-    root = ET.Element("Test")
     attribs = {"Severity": "10"}
     attribs.update(info)
-    ET.SubElement(root, "JoshuaMessage", attribs)
-    return ET.tostring(root) + b"\n"
+    return _wrap("JoshuaMessage", attribs)
 
 
+# The instance and host never change while the process runs.
+@functools.lru_cache(maxsize=1)
 def get_hostname():
     if INSTANCE_ID_ENV_VAR in os.environ:
         return os.environ[INSTANCE_ID_ENV_VAR]
@@ -176,6 +217,11 @@ def get_hostname():
         return socket.gethostname()
 
 
+@functools.lru_cache(maxsize=1)
+def _packed_hostname():
+    return fdb.tuple.pack((get_hostname(),))
+
+
 def is_message(text):
     # Hmm...perhaps this could be better.
     return text.startswith("<Test><JoshuaMessage")
@@ -183,22 +229,39 @@ def is_message(text):
 
 def unwrap_message(text):
     root = ET.fromstring(text)
-    return root.getchildren()[0].attrib
+    return root[0].attrib
 
 
+# Every listing parses the same submission times, so remember them.
+@functools.lru_cache(maxsize=4096)
 def load_datetime(string):
     #    print( 'string: {}  now: {}'.format(string, format_datetime(datetime.datetime.now(timezone.utc))) )
+    # format_datetime always writes the fixed-width YYYYmmdd-HHMMSS.
+    if len(string) == 15 and string[8] == "-":
+        return datetime.datetime(
+            int(string[0:4]),
+            int(string[4:6]),
+            int(string[6:8]),
+            int(string[9:11]),
+            int(string[11:13]),
+            int(string[13:15]),
+            tzinfo=datetime.timezone.utc,
+        )
     return datetime.datetime.strptime(string, TIMESTAMP_FMT).replace(tzinfo=datetime.timezone.utc)
 
 
 def load_timedelta(string):
+    # Parses str(timedelta) output, "[D day[s], ]H:MM:SS[.ffffff]", which is
+    # what format_timedelta stores.
+    days = 0
+    clock = string
     if "day" in string:
-        m = TIMEDELTA_REGEX1.match(string)
-    else:
-        m = TIMEDELTA_REGEX2.match(string)
-    parse_info = {key: float(val) for key, val in m.groupdict().items()}
-    #    print( 'string: {}  parsed: {}'.format(string, parse_info) )
-    return datetime.timedelta(**parse_info)
+        day_part, _, clock = string.partition(", ")
+        days = int(day_part.split(" ", 1)[0])
+    hours, minutes, seconds = clock.split(":")
+    return datetime.timedelta(
+        days=days, hours=int(hours), minutes=int(minutes), seconds=float(seconds)
+    )
 
 
 def format_timedelta(timedelta_obj):
@@ -223,6 +286,25 @@ def identify_existing_ensembles(tr, ensembles):
     return list(filter(lambda eid: tr[dir_all_ensembles[eid]] != None, ensembles))
 
 
+def wait_for_any(*futures, timeout=None):
+    """
+    Block until one of the given futures is ready or timeout seconds pass.
+    Returns the index of the first future to become ready, or None if the
+    wait timed out.
+    """
+    ready = threading.Event()
+    first = []
+
+    def on_ready(_, i):
+        first.append(i)
+        ready.set()
+
+    for i, f in enumerate(futures):
+        f.on_ready(lambda f, i=i: on_ready(f, i))
+    ready.wait(timeout)
+    return first[0] if first else None
+
+
 @transactional
 def list_and_watch_active_ensembles(tr) -> Tuple[List[str], fdb.Future]:
     return _list_and_watch_ensembles(tr, dir_active, dir_active_changes)
@@ -251,11 +333,14 @@ def get_ensemble_properties(tr, ensemble, snapshot=False):
 
 
 def _unpack_property(ensemble, key, value, into):
-    t = dir_all_ensembles[ensemble].unpack(key)
+    _unpack_property_tuple(dir_all_ensembles[ensemble].unpack(key), value, into)
+
+
+def _unpack_property_tuple(t, value, into):
     if t[0] == "properties":
         into[t[1]] = fdb.tuple.unpack(value)[0]
     elif t[0] == "count":
-        into[t[1]] = struct.unpack("<Q", value)[0]
+        into[t[1]] = _U64LE.unpack(value)[0]
 
 
 def _list_ensembles(tr, dir) -> List[Tuple[str, Dict]]:
@@ -291,7 +376,8 @@ def list_sanity_ensembles(tr) -> List[Tuple[str, Dict]]:
 
 
 def list_all_ensembles() -> List[Tuple[str, Dict]]:
-    ensembles: List[Tuple[str, Dict]] = []
+    # Ensemble IDs sort in key order, so insertion order is listing order.
+    props_by_ensemble: Dict[str, Dict] = {}
     r = dir_all_ensembles.range()
     start = r.start
     tr = db.create_transaction()
@@ -303,11 +389,12 @@ def list_all_ensembles() -> List[Tuple[str, Dict]]:
             ):
                 start = k + b"\x00"
                 t = dir_all_ensembles.unpack(k)
-                if len(t) == 1:
-                    ensembles.append((t[0], {}))
-                else:
-                    _unpack_property(ensembles[-1][0], k, v, ensembles[-1][1])
-            return ensembles
+                props = props_by_ensemble.get(t[0])
+                if props is None:
+                    props = props_by_ensemble[t[0]] = {}
+                if len(t) > 1:
+                    _unpack_property_tuple(t[1:], v, props)
+            return list(props_by_ensemble.items())
         except FDBError as e:
             # If we get transaction_too_old and we made progress with the current transaction,
             # continue where we left off with a new transaction.
@@ -317,15 +404,92 @@ def list_all_ensembles() -> List[Tuple[str, Dict]]:
                 tr.on_error(e).wait()
 
 
+def get_latest_active_ensemble(stopped, sanity=False, username=None) -> Optional[str]:
+    """
+    Return the newest ensemble that get_active_ensembles would list for the
+    same arguments, or None if there is none. Ensemble IDs sort by creation
+    time, so this walks the directory backwards and stops at the first match
+    rather than reading every ensemble and its properties.
+    """
+    if stopped:
+        dir = dir_all_ensembles
+    elif sanity:
+        dir = dir_sanity
+    else:
+        dir = dir_active
+    r = dir.range()
+    stop = r.stop
+    tr = db.create_transaction()
+    while True:
+        prev_stop = stop
+        try:
+            if stopped:
+                # Walking dir_all_ensembles backwards passes each ensemble's
+                # properties just before the ensemble's own key.
+                owner = None
+                for k, v in tr.get_range(r.start, stop, reverse=True):
+                    t = dir.unpack(k)
+                    if len(t) != 1:
+                        if t[1:] == ("properties", "username"):
+                            owner = fdb.tuple.unpack(v)[0]
+                        continue
+                    # Only resume from an ensemble's key, so that a new
+                    # transaction doesn't skip the next one's properties.
+                    stop = k
+                    if not username or owner == username:
+                        return t[0]
+                    owner = None
+                return None
+
+            limit = LATEST_ENSEMBLE_BATCH if username else 1
+            while True:
+                keys = [
+                    k for k, _ in tr.get_range(r.start, stop, limit=limit, reverse=True)
+                ]
+                if not keys:
+                    return None
+                ensembles = [dir.unpack(k)[0] for k in keys]
+                if not username:
+                    return ensembles[0]
+                # Issue every read before waiting on any of them.
+                owners = [
+                    tr[dir_all_ensembles[e]["properties"]["username"]]
+                    for e in ensembles
+                ]
+                for ensemble, owner in zip(ensembles, owners):
+                    if owner.present() and fdb.tuple.unpack(owner)[0] == username:
+                        return ensemble
+                stop = keys[-1]
+                if len(keys) < limit:
+                    return None
+        except FDBError as e:
+            # As in list_all_ensembles, pick up where we left off after
+            # transaction_too_old if the scan made progress.
+            if e.code == 1007 and stop != prev_stop:
+                tr = db.create_transaction()
+            else:
+                tr.on_error(e).wait()
+
+
 @transactional
 def get_ensemble_mean_durations(tr, ensembles=None):
     if not ensembles:
         ensembles = map(lambda x: x[0], list_active_ensembles(tr))
 
+    # Issue every read before waiting on any of them.
+    reads = [
+        (
+            ensemble,
+            tr.snapshot.get(dir_all_ensembles[ensemble]["count"]["duration"]),
+            tr.snapshot.get(dir_all_ensembles[ensemble]["count"]["ended"]),
+        )
+        for ensemble in ensembles
+    ]
+
     duration_map = {}
-    for ensemble in ensembles:
-        duration = _get_snap_counter(tr, ensemble, "duration")
-        ended = _get_snap_counter(tr, ensemble, "ended")
+    for ensemble, duration, ended in reads:
+        duration = _unpack_counter(duration)
+        ended = _unpack_counter(ended)
 
         if ended == 0:
             duration_map[ensemble] = 1.0
@@ -340,9 +504,15 @@ def get_ensemble_priorities(tr, ensembles=None):
     if not ensembles:
         ensembles = map(lambda x: x[0], list_active_ensembles(tr))
 
+    # Issue every read before waiting on any of them.
+    reads = [
+        (ensemble, tr.snapshot.get(dir_all_ensembles[ensemble]["count"]["priority"]))
+        for ensemble in ensembles
+    ]
+
     priority_map = {}
-    for ensemble in ensembles:
-        priority = _get_snap_counter(tr, ensemble, "priority")
+    for ensemble, priority in reads:
+        priority = _unpack_counter(priority)
         if priority == 0:
             priority = 100
         priority_map[ensemble] = priority / float(100)
@@ -350,32 +520,89 @@ def get_ensemble_priorities(tr, ensembles=None):
     return priority_map
 
 
+@transactional
+def get_ensemble_priorities_and_durations(tr, ensembles):
+    """
+    Return {ensemble: (priority, mean_duration)}, with the same defaults as
+    get_ensemble_priorities and get_ensemble_mean_durations. Every counter
+    read is issued before any of them is waited on, so they are served in
+    one round trip instead of one per counter.
+    """
+    reads = []
+    for ensemble in ensembles:
+        counters = dir_all_ensembles[ensemble]["count"]
+        reads.append(
+            (
+                ensemble,
+                tr.snapshot.get(counters["priority"]),
+                tr.snapshot.get(counters["duration"]),
+                tr.snapshot.get(counters["ended"]),
+            )
+        )
+
+    weights = {}
+    for ensemble, priority, duration, ended in reads:
+        priority = _unpack_counter(priority) or 100
+        ended = _unpack_counter(ended)
+        if ended == 0:
+            mean_duration = 1.0
+        else:
+            mean_duration = max(1.0, _unpack_counter(duration) * 1.0 / ended)
+        weights[ensemble] = (priority / float(100), mean_duration)
+
+    return weights
+
+
 @fdb.transactional
 def _insert_blobpart(tr, subspace, offset, data):
-    for rel_offs in range(0, min(BLOB_TRANSACTION_LIMIT, len(data)), BLOB_KEY_LIMIT):
+    for rel_offs in range(0, len(data), BLOB_KEY_LIMIT):
         tr[subspace[offset + rel_offs]] = data[rel_offs : rel_offs + BLOB_KEY_LIMIT]
 
 
+# The parts of a blob are written to disjoint keys, so their transactions
+# never conflict and can commit concurrently. At most BLOB_UPLOAD_CONCURRENCY
+# commits are left in flight, which bounds the memory used.
 def _insert_blob(db, subspace, file, offset=0, verbose=False):
     if verbose:
-        sys.stderr.write("Uploading: .=%d: " % BLOB_TRANSACTION_LIMIT)
+        sys.stderr.write("Uploading: .=%d: " % BLOB_COMMIT_BYTES)
     file.seek(offset)
+    pending = deque()
     while True:
-        data = file.read(BLOB_TRANSACTION_LIMIT)
+        data = file.read(BLOB_COMMIT_BYTES)
         if not data:
-            if verbose:
-                sys.stderr.write(" DONE! Total=%d\n" % offset)
             break
-        _insert_blobpart(db, subspace, offset, data)
+        if len(pending) == BLOB_UPLOAD_CONCURRENCY:
+            _finish_blobpart(*pending.popleft())
+            if verbose:
+                sys.stderr.write(".")
+        tr = db.create_transaction()
+        _insert_blobpart(tr, subspace, offset, data)
+        pending.append((tr, subspace, offset, data, tr.commit()))
+        offset += len(data)
+    while pending:
+        _finish_blobpart(*pending.popleft())
         if verbose:
             sys.stderr.write(".")
-        offset += len(data)
+    if verbose:
+        sys.stderr.write(" DONE! Total=%d\n" % offset)
 
 
-@fdb.transactional
-def _read_blobpart(tr, subspace, offset):
+def _finish_blobpart(tr, subspace, offset, data, commit):
+    # Writing a part is idempotent, so it can simply be redone on any
+    # retryable error, including commit_unknown_result.
+    while True:
+        try:
+            commit.wait()
+            return
+        except FDBError as e:
+            tr.on_error(e).wait()
+            _insert_blobpart(tr, subspace, offset, data)
+            commit = tr.commit()
+
+
+def _join_blobpart(kvs, subspace, offset):
     data = []
-    for k, v in tr[subspace[offset] : subspace[offset + BLOB_TRANSACTION_LIMIT]]:
+    for k, v in kvs:
         # print( len(data), offset, len(v), repr(k), repr(subspace[offset].key()) )
         assert subspace[offset].key() == k
         data.append(v)
@@ -385,8 +612,54 @@ def _read_blobpart(tr, subspace, offset):
     return b"".join(data)
 
 
+@fdb.transactional
+def _read_blobpart(tr, subspace, offset):
+    return _join_blobpart(
+        tr[subspace[offset] : subspace[offset + BLOB_TRANSACTION_LIMIT]],
+        subspace,
+        offset,
+    )
+
+
+# Blobs written by _insert_blob have a key at every multiple of
+# BLOB_KEY_LIMIT, so range reads of consecutive BLOB_TRANSACTION_LIMIT windows
+# can be issued ahead of time in one transaction and will line up. A short
+# window is the end of the blob. A window that returns more than its size
+# means the keys are laid out differently, and the rest of the blob is read
+# one window after another.
 def _read_blob(db, subspace, file):
     offset = 0
+    tr = db.create_transaction()
+    while True:
+        prev_offset = offset
+        try:
+            windows = deque()
+            while True:
+                while len(windows) < BLOB_DOWNLOAD_CONCURRENCY:
+                    begin = offset + len(windows) * BLOB_TRANSACTION_LIMIT
+                    windows.append(
+                        tr.get_range(
+                            subspace[begin],
+                            subspace[begin + BLOB_TRANSACTION_LIMIT],
+                            streaming_mode=fdb.StreamingMode.want_all,
+                        )
+                    )
+                data = _join_blobpart(windows.popleft(), subspace, offset)
+                file.write(data)
+                offset += len(data)
+                if len(data) < BLOB_TRANSACTION_LIMIT:
+                    return
+                if len(data) > BLOB_TRANSACTION_LIMIT:
+                    break
+            break
+        except FDBError as e:
+            # If we get transaction_too_old and we made progress with the current transaction,
+            # continue where we left off with a new transaction.
+            if e.code == 1007 and offset != prev_offset:
+                tr = db.create_transaction()
+            else:
+                tr.on_error(e).wait()
+
     while True:
         data = _read_blobpart(db, subspace, offset)
         if not data:
@@ -408,8 +681,9 @@ def _create_ensemble(tr, ensemble_id, properties, sanity=False):
         print("{} already inserted".format(ensemble_id))
         return  # Already inserted
     tr[dir_all_ensembles[ensemble_id]] = b""
+    props = dir_all_ensembles[ensemble_id]["properties"]
     for k, v in properties.items():
-        tr[dir_all_ensembles[ensemble_id]["properties"][k]] = fdb.tuple.pack((v,))
+        tr[props[k]] = fdb.tuple.pack((v,))
     tr[dir[ensemble_id]] = b""
     tr.add(changes, ONE)
 
@@ -439,9 +713,10 @@ def create_ensemble(userid, properties, tarball, sanity=False, use_s3=False):
         _insert_blob(db, dir_ensemble_data[ensemble_id], tarball, 0, True)
     _create_ensemble(db, ensemble_id, properties, sanity)
     logger.debug(
-        "created ensemble {}, properties: {}, sanity: {}".format(
-            ensemble_id, properties, sanity
-        )
+        "created ensemble %s, properties: %s, sanity: %s",
+        ensemble_id,
+        properties,
+        sanity,
     )
     return ensemble_id
 
@@ -450,8 +725,10 @@ def stop_user_ensembles(username, sanity=False):
     if not username:
         raise Exception("Unable to stop ensembles belonging to unspecified user.")
     ensemble_list = get_active_ensembles(False, sanity, username)
+    # IDs are YYYYmmdd-HHMMSS-username-hash.
+    owner_prefix = username + "-"
     for e, props in ensemble_list:
-        if "-" + username + "-" in str(e):
+        if str(e)[16:].startswith(owner_prefix):
             stop_ensemble(e, sanity)
 
 
@@ -470,11 +747,12 @@ def get_active_ensembles(
             filter(lambda i: i[1].get("username", None) == username, ensemble_list)
         )
     # Determine the runtime, if not defined
+    now = datetime.datetime.now(datetime.timezone.utc)
     for e, props in ensemble_list:
         if props.get("runtime", None) is None:
             if props.get("submitted", None) is not None:
                 props["runtime"] = format_timedelta(
-                    datetime.datetime.now(datetime.timezone.utc) - load_datetime(props["submitted"])
+                    now - load_datetime(props["submitted"])
                 )
         if props.get("stopped", None) is not None:
             props["remaining"] = "0"
@@ -504,24 +782,23 @@ def get_active_ensembles(
 def _stop_ensemble(tr, ensemble_id, sanity=False):
     dir, changes = get_dir_changes(sanity)
 
+    # Issue all of the reads before waiting on any of them.
+    exists = tr[dir_all_ensembles[ensemble_id]]
+    active = tr[dir[ensemble_id]]
+    submitted_value = tr[dir_all_ensembles[ensemble_id]["properties"]["submitted"]]
+
     # print(dir, dir_all_ensembles[ensemble_id], ensemble_id, dir[ensemble_id])
-    if tr[dir_all_ensembles[ensemble_id]] == None:
+    if exists == None:
         raise Exception("Ensemble " + ensemble_id + " does not exist")
 
     # Set the stopped and runtime, if not set
-    if tr[dir[ensemble_id]] is not None:
+    if active != None:
         # Get the current time
         stoptime = datetime.datetime.now(datetime.timezone.utc)
-        # Get the ensemble properties
-        properties = get_ensemble_properties(ensemble_id)
         # Get the ensemble submission time, if not defined use now
         submitted = (
-            load_datetime(
-                fdb.tuple.unpack(
-                    tr[dir_all_ensembles[ensemble_id]["properties"]["submitted"]]
-                )[0]
-            )
-            if "submitted" in properties
+            load_datetime(fdb.tuple.unpack(submitted_value)[0])
+            if submitted_value != None
             else stoptime
         )
 
@@ -535,8 +812,9 @@ def _stop_ensemble(tr, ensemble_id, sanity=False):
         )
 
     del tr[dir[ensemble_id]]
-    del tr[dir_ensemble_incomplete[ensemble_id]]
-    del tr[dir_ensemble_incomplete[ensemble_id].range()]
+    # Clear the incomplete subspace's own key and everything under it at once.
+    incomplete = dir_ensemble_incomplete[ensemble_id]
+    tr.clear_range(incomplete.key(), incomplete.range().stop)
     tr.add(changes, ONE)
 
 
@@ -626,7 +904,7 @@ def set_versionstamped_key(tr, prefix, suffix, value):
         + b"\x1d\x0b\x01"
         + b"." * 10
         + suffix
-        + struct.pack("<I", len(prefix) + 3),
+        + _U32LE.pack(len(prefix) + 3),
         value,
     )
 
@@ -636,31 +914,21 @@ def _increment(tr: fdb.Transaction, ensemble_id: str, counter: str) -> None:
 
 
 def _decrement(tr: fdb.Transaction, ensemble_id: str, counter: str) -> None:
-    tr.add(dir_all_ensembles[ensemble_id]["count"][counter], struct.pack("<q", -1))
+    tr.add(dir_all_ensembles[ensemble_id]["count"][counter], MINUS_ONE)
 
 
-def _add(tr: fdb.Transaction, ensemble_id: str, counter: str, value: int) -> None:
-    byte_val = struct.pack("<Q", value)
-    tr.add(dir_all_ensembles[ensemble_id]["count"][counter], byte_val)
-
-
-def _get_snap_counter(tr: fdb.Transaction, ensemble_id: str, counter: str) -> int:
-    value = tr.snapshot.get(dir_all_ensembles[ensemble_id]["count"][counter])
+def _unpack_counter(value) -> int:
     if value == None:
         return 0
     else:
-        return struct.unpack("<Q", b"" + value)[0]
+        # bytes() on an fdb Value hands back its cached buffer without copying.
+        return _U64LE.unpack(bytes(value))[0]
 
 
-def _get_seeds_and_heartbeats(
-    ensemble_id: str, tr: fdb.Transaction
-) -> List[Tuple[int, float]]:
-    result = []
-    for k, v in tr.snapshot[dir_ensemble_incomplete[ensemble_id]["heartbeat"].range()]:
-        (seed,) = dir_ensemble_incomplete[ensemble_id]["heartbeat"].unpack(k)
-        (heartbeat,) = fdb.tuple.unpack(v)
-        result.append((seed, heartbeat))
-    return result
+def _get_snap_counter(tr: fdb.Transaction, ensemble_id: str, counter: str) -> int:
+    return _unpack_counter(
+        tr.snapshot.get(dir_all_ensembles[ensemble_id]["count"][counter])
+    )
 
 
 def _get_hostname(ensemble_id: str, seed: int, tr: fdb.Transaction) -> Optional[str]:
@@ -682,17 +950,19 @@ def should_run_ensemble(tr: fdb.Transaction, ensemble_id: str) -> bool:
     max_runs = props.get("max_runs", 0)
     # max_runs == 0 means run forever
     if max_runs > 0 and started >= max_runs:
-        current_time = time.time()
+        heartbeats = dir_ensemble_incomplete[ensemble_id]["heartbeat"]
         max_seed = None
-        max_heartbeat_age = None
-        for seed, heartbeat in _get_seeds_and_heartbeats(ensemble_id, tr):
-            assert type(seed) == int
-            if max_seed is None or current_time - heartbeat > max_heartbeat_age:
-                max_seed = seed
-                max_heartbeat_age = current_time - heartbeat
-        if max_heartbeat_age is None:
+        oldest_heartbeat = None
+        for k, v in tr.snapshot[heartbeats.range()]:
+            (heartbeat,) = fdb.tuple.unpack(v)
+            if oldest_heartbeat is None or heartbeat < oldest_heartbeat:
+                (max_seed,) = heartbeats.unpack(k)
+                oldest_heartbeat = heartbeat
+        if oldest_heartbeat is None:
             # No other agents are running a test for this ensemble (is this possible?)
             return True
+        assert type(max_seed) == int
+        max_heartbeat_age = time.time() - oldest_heartbeat
         if max_heartbeat_age > 10:
             print(
                 "Agent {} presumed dead. Attempting to steal its work.".format(
@@ -703,12 +973,11 @@ def should_run_ensemble(tr: fdb.Transaction, ensemble_id: str) -> bool:
             _decrement(tr, ensemble_id, "started")
             # If we read at snapshot isolation then an arbitrary number of agents could steal this run/seed.
             # We only want one agent to succeed in taking over for the dead agent's run/seed.
-            tr.add_read_conflict_key(
-                dir_ensemble_incomplete[ensemble_id]["heartbeat"][max_seed]
-            )
-            del tr[dir_ensemble_incomplete[ensemble_id][max_seed]]
-            del tr[dir_ensemble_incomplete[ensemble_id][max_seed].range()]
-            del tr[dir_ensemble_incomplete[ensemble_id]["heartbeat"][max_seed]]
+            incomplete = dir_ensemble_incomplete[ensemble_id]
+            tr.add_read_conflict_key(incomplete["heartbeat"][max_seed])
+            del tr[incomplete[max_seed]]
+            del tr[incomplete[max_seed].range()]
+            del tr[incomplete["heartbeat"][max_seed]]
             return True
         return False
     else:
@@ -741,15 +1010,25 @@ def show_in_progress(tr: fdb.Transaction, ensemble_id: str) -> List[Tuple[int, D
 def try_starting_test(tr, ensemble_id, seed, sanity=False) -> bool:
     """Return true if we should continue executing this test"""
     dir, _ = get_dir_changes(sanity)
+    incomplete = dir_ensemble_incomplete[ensemble_id]
+    run = incomplete[seed]
 
-    if tr[dir[ensemble_id]] == None:
+    # Issue all of the reads before waiting on any of them.
+    active = tr[dir[ensemble_id]]
+    owner = tr[run]
+    r = dir_all_ensembles[ensemble_id].range()
+    prop_kvs = tr.get_range(r.start, r.stop, streaming_mode=fdb.StreamingMode.want_all)
+
+    if active == None:
         # Ensemble is stopped
         return False
-    if tr[dir_ensemble_incomplete[ensemble_id][seed]] != None:
+    if owner != None:
         # Don't run the same seed twice simultaneously
-        return tr[dir_ensemble_incomplete[ensemble_id][seed]] == instanceid
+        return owner == instanceid
 
-    props = _get_ensemble_properties(tr, ensemble_id)
+    props = {}
+    for k, v in prop_kvs:
+        _unpack_property(ensemble_id, k, v, props)
     started = props.get("started", 0)
     max_runs = props.get("max_runs", 0)
     if max_runs > 0 and started >= max_runs:
@@ -760,31 +1039,23 @@ def try_starting_test(tr, ensemble_id, seed, sanity=False) -> bool:
     # want
     _increment(tr, ensemble_id, "started")
 
-    tr[dir_ensemble_incomplete[ensemble_id][seed]] = instanceid
+    tr[run] = instanceid
     current_time = time.time()
-    tr[dir_ensemble_incomplete[ensemble_id][seed]["began_at"]] = fdb.tuple.pack(
-        (current_time,)
-    )
-    tr[dir_ensemble_incomplete[ensemble_id][seed]["hostname"]] = fdb.tuple.pack(
-        (get_hostname(),)
-    )
-    tr[dir_ensemble_incomplete[ensemble_id]["heartbeat"][seed]] = fdb.tuple.pack(
-        (current_time,)
-    )
+    tr[run["began_at"]] = fdb.tuple.pack((current_time,))
+    tr[run["hostname"]] = _packed_hostname()
+    tr[incomplete["heartbeat"][seed]] = fdb.tuple.pack((current_time,))
     return True
 
 
 @transactional
 def heartbeat_and_check_running(tr, ensemble_id, seed, sanity=False):
     dir, _ = get_dir_changes(sanity)
-    result = (
-        tr[dir[ensemble_id]] != None
-        and tr[dir_ensemble_incomplete[ensemble_id][seed]] == instanceid
-    )
+    incomplete = dir_ensemble_incomplete[ensemble_id]
+    active = tr[dir[ensemble_id]]
+    owner = tr[incomplete[seed]]
+    result = active != None and owner == instanceid
     if result:
-        tr[dir_ensemble_incomplete[ensemble_id]["heartbeat"][seed]] = fdb.tuple.pack(
-            (time.time(),)
-        )
+        tr[incomplete["heartbeat"][seed]] = fdb.tuple.pack((time.time(),))
     return result
 
 
@@ -801,42 +1072,51 @@ def _insert_results(
     duration=0,
 ):
     dir, _ = get_dir_changes(sanity)
+    incomplete = dir_ensemble_incomplete[ensemble_id]
+    run = incomplete[seed]
+    counts = dir_all_ensembles[ensemble_id]["count"]
+
+    # Issue all of the reads before waiting on any of them. The counters are
+    # snapshot reads so that two insertions don't conflict. They are issued
+    # before this transaction's own increments, so they don't include them.
+    active = tr[dir[ensemble_id]]
+    owner = tr[run]
+    failures = (
+        tr.snapshot.get(counts["fail"]) if result_code and fail_fast > 0 else None
+    )
+    ended = tr.snapshot.get(counts["ended"]) if max_runs > 0 else None
 
-    if tr[dir[ensemble_id]] == None:
+    if active == None:
         # Don't insert any more results for stopped ensembles
         return False
 
-    if tr[dir_ensemble_incomplete[ensemble_id][seed]] == None:
+    if owner == None:
         # Test already completed
         return False
-    del tr[dir_ensemble_incomplete[ensemble_id][seed]]
-    del tr[dir_ensemble_incomplete[ensemble_id][seed].range()]
-    del tr[dir_ensemble_incomplete[ensemble_id]["heartbeat"][seed]]
+    del tr[run]
+    del tr[run.range()]
+    del tr[incomplete["heartbeat"][seed]]
 
-    _increment(tr, ensemble_id, "ended")
+    tr.add(counts["ended"], ONE)
 
     if result_code:
-        _increment(tr, ensemble_id, "fail")
+        tr.add(counts["fail"], ONE)
         results = dir_ensemble_results_fail
 
         if fail_fast > 0:
-            # This is a snapshot read so that two insertions don't conflict.
-            failures = _get_snap_counter(tr, ensemble_id, "fail")
-            if failures >= fail_fast:
+            if _unpack_counter(failures) + 1 >= fail_fast:
                 _stop_ensemble(tr, ensemble_id, sanity)
 
     else:
-        _increment(tr, ensemble_id, "pass")
+        tr.add(counts["pass"], ONE)
         results = dir_ensemble_results_pass
 
     if max_runs > 0:
-        # This is a snapshot read so that two insertions don't conflict.
-        ended = _get_snap_counter(tr, ensemble_id, "ended")
-        if ended >= max_runs:
+        if _unpack_counter(ended) + 1 >= max_runs:
             _stop_ensemble(tr, ensemble_id, sanity)
 
     if duration:
-        _add(tr, ensemble_id, "duration", int(duration))
+        tr.add(counts["duration"], _U64LE.pack(int(duration)))
 
     set_versionstamped_key(
         tr,
@@ -930,70 +1210,96 @@ def _read_and_watch_results(tr, results_dirs, ensemble_id, begin_versionstamp):
     )
 
 
+def _read_result_blob(ensemble_id, msg) -> bytes:
+    key = msg["BlobKey"]
+    blob_version = "1" if "BlobVersion" not in msg else msg["BlobVersion"]
+    if blob_version == "1":
+        subspace = dir_ensemble_results_large[key]
+    elif blob_version == "2":
+        subspace = dir_ensemble_results_large[ensemble_id][key]
+    else:
+        raise ValueError("Unknown BlobVersion " + blob_version)
+    blob_output = BytesIO()
+    _read_blob(db, subspace, blob_output)
+    return blob_output.getvalue()
+
+
+def _parse_result(item, compressed):
+    """
+    Return (item with its output decoded, blob message or None) for a row of
+    _read_and_watch_results.
+    """
+    text = item[-1] if not compressed else zlib.decompress(item[-1])
+    text = text.decode(encoding="utf-8", errors="backslashreplace")
+    new_item = item[:-1] + (text,)
+
+    if is_message(text):
+        try:
+            msg = unwrap_message(text)
+            if "Message" in msg and msg["Message"] == "value_in_blob":
+                return new_item, msg
+        except Exception:
+            # Could not parse the message. Just yield the item.
+            traceback.print_exc()
+    return new_item, None
+
+
 def tail_results(ensemble_id, errors_only=False, compressed=True):
     result_dirs = [dir_ensemble_results_fail]
     if not errors_only:
         result_dirs.append(dir_ensemble_results_pass)
 
-    begin_versionstamp = 0
-    more = True
-    while more:
-        block, watches, more = _read_and_watch_results(
-            db, result_dirs, ensemble_id, begin_versionstamp
-        )
-        if block:
-            begin_versionstamp = block[-1][0] + 1
-            for item in block:
-                text = item[-1] if not compressed else zlib.decompress(item[-1])
-                text = text.decode(encoding="utf-8", errors="backslashreplace")
-                new_item = item[:-1] + (text,)
-
-                if is_message(text):
+    # Blob reads run on their own threads so that they overlap with the
+    # consumer.
+    pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=TAIL_BLOB_PREFETCH, thread_name_prefix="tail"
+    )
+    fetches = {}
+    try:
+        begin_versionstamp = 0
+        more = True
+        while more:
+            block, watches, more = _read_and_watch_results(
+                db, result_dirs, ensemble_id, begin_versionstamp
+            )
+            if block:
+                begin_versionstamp = block[-1][0] + 1
+                parsed = [_parse_result(item, compressed) for item in block]
+                blob_items = deque(
+                    i for i, (_, msg) in enumerate(parsed) if msg is not None
+                )
+                for i, (new_item, msg) in enumerate(parsed):
+                    # Keep the next few blobs downloading while earlier
+                    # results are being consumed.
+                    while blob_items and len(fetches) < TAIL_BLOB_PREFETCH:
+                        j = blob_items.popleft()
+                        fetches[j] = pool.submit(
+                            _read_result_blob, ensemble_id, parsed[j][1]
+                        )
+
+                    if msg is None:
+                        yield new_item
+                        continue
+
                     try:
-                        msg = unwrap_message(text)
-
-                        if "Message" in msg and msg["Message"] == "value_in_blob":
-                            # Unpack the value from the blob.
-                            key = msg["BlobKey"]
-                            blob_output = BytesIO()
-                            blob_version = (
-                                "1" if "BlobVersion" not in msg else msg["BlobVersion"]
-                            )
-
-                            if blob_version == "1":
-                                _read_blob(
-                                    db, dir_ensemble_results_large[key], blob_output
-                                )
-                            elif blob_version == "2":
-                                _read_blob(
-                                    db,
-                                    dir_ensemble_results_large[ensemble_id][key],
-                                    blob_output,
-                                )
-                            else:
-                                raise ValueError("Unknown BlobVersion " + blob_version)
-                            decompressed = (
-                                zlib.decompress(blob_output.getvalue())
-                                if compressed
-                                else blob_output.getvalue()
-                            )
-                            yield item[:-1] + (
-                                decompressed.decode(
-                                    encoding="utf-8", errors="backslashreplace"
-                                ),
-                            )
-                        else:
-                            yield new_item
+                        data = fetches.pop(i).result()
+                        if compressed:
+                            data = zlib.decompress(data)
+                        text = data.decode(encoding="utf-8", errors="backslashreplace")
                     except Exception:
-                        # Could not parse the message. Just yield the item.
+                        # Could not read the blob. Just yield the item.
                         traceback.print_exc()
                         yield new_item
-                else:
-                    yield new_item
-        if watches:
-            fdb.Future.wait_for_any(*watches)
-            for w in watches:
-                w.cancel()
+                    else:
+                        yield new_item[:-1] + (text,)
+            if watches:
+                fdb.Future.wait_for_any(*watches)
+                for w in watches:
+                    w.cancel()
+    finally:
+        for f in fetches.values():
+            f.cancel()
+        pool.shutdown(wait=False)
 
 
 @transactional
@@ -1007,7 +1313,7 @@ def log_agent_failure(error_message):
     """
     timestamp = int(time.time())
     hostname = get_hostname()
-    random_bytes = bytes(bytearray([random.getrandbits(8) for _ in range(32)]))
+    random_bytes = os.urandom(32)
     _log_agent_failure(
         timestamp, hostname, random_bytes, bytes(error_message, encoding="utf-8")
     )
@@ -27,10 +27,12 @@
 import errno
 import os
 import re
+import select
 import signal
 import subprocess
 import threading
 import time
+import weakref
 
 VAR_NAME = "OF_HOUSE_JOSHUA"
 
@@ -115,9 +117,12 @@ def get_environment(pid):
 # Get all child processes by looking for those with the correct
 # Joshua ID.
 def retrieve_children(pid=str(os.getpid())):
+    # get_environment() returns bytes, so compare against the encoded marker.
+    name = VAR_NAME.encode()
+    value = pid.encode()
+
     def check(candidate):
-        env = get_environment(candidate)
-        return VAR_NAME in env and env[VAR_NAME] == pid
+        return get_environment(candidate).get(name) == value
 
     return filter(check, get_all_process_pids())
 
@@ -129,26 +134,8 @@ def retrieve_children(pid=str(os.getpid())):
 #     <i>Because death could not stop for me -- I kindly stopped for him.</i>
 #                                           -- Emily Dickinson
 def wait_for_death(pid, timeout=5):
-    def wait_helper(p):
-        try:
-            os.waitpid(p, 0)
-        except OSError as e:
-            if e.errno == errno.ECHILD:
-                # No process exists. Most likely, the process has already exited.
-                pass
-            else:
-                raise e
-
     try:
-        # Create a threading object and to wait for the pid to die.
-        t = threading.Thread(target=wait_helper, args=(pid,))
-        t.start()
-
-        # Actually wait for death, only going as far as timeout.
-        t.join(timeout=timeout)
-
-        # Success.
-        ret_val = True
+        ret_val = _wait_for_death_pidfd(pid, timeout)
     except Exception:
         # Something bad happened. Assume this failed.
         ret_val = False
@@ -159,47 +146,181 @@ def wait_for_death(pid, timeout=5):
     return ret_val
 
 
-# Kills all the processes spun off from the current process.
-def kill_all_children(pid=str(os.getpid())):
-    child_pids = list(sorted(map(int, retrieve_children(pid))))
+# Wait on a pidfd (Linux 5.3+), which becomes readable as soon as the process
+# exits. This lets us sleep in the kernel instead of dedicating a thread to a
+# blocking waitpid for every process we are waiting on.
+def _wait_for_death_pidfd(pid, timeout):
+    if not hasattr(os, "pidfd_open"):
+        return _wait_for_death_thread(pid, timeout)
 
-    if len(child_pids) == 0:
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        # The process is already gone.
         return True
+    except OSError:
+        # Kernel does not support pidfds.
+        return _wait_for_death_thread(pid, timeout)
 
-    # Send the terminate signal to each.
-    for child_pid in child_pids:
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            return False
+    finally:
+        os.close(pidfd)
+
+    # Reap the process if it is one of our children.
+    try:
+        os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        pass
+    return True
+
+
+def _wait_for_death_thread(pid, timeout):
+    def wait_helper(p):
         try:
-            # Kill, then wait for death for each process.
-            os.kill(child_pid, signal.SIGKILL)
-            wait_for_death(child_pid)
-        except OSError:
-            # We couldn't kill the current process (possibly
-            # because it is already dead).
+            os.waitpid(p, 0)
+        except ChildProcessError:
+            # No process exists. Most likely, the process has already exited.
             pass
 
-    # Because os.waitpid still has issues..
-    # FIXME: This may actually be unnecessary.
-    time.sleep(1)
+    # Create a threading object and to wait for the pid to die.
+    t = threading.Thread(target=wait_helper, args=(pid,))
+    t.daemon = True
+    t.start()
 
-    stragglers = len(filter(check_alive, child_pids))
+    # Actually wait for death, only going as far as timeout.
+    t.join(timeout=timeout)
+    return not t.is_alive()
 
-    if stragglers > 0:
-        # Could not kill everything. Raise an error to force restart.
-        raise OSError("Not all of the child processes could be killed during cleanup.")
 
-    # As a final check, retrieve all child PIDs. If there's anything
-    # here, it means that there are still some processes were started
-    # up after we identified those that were to be killed.
-    new_child_pids = len(retrieve_children(pid))
-    if new_child_pids > 0:
-        raise OSError("New processes were begun after children were identified.")
+# Returns whether the given process has exited, reaping it if it is one of
+# our own children.
+def _reaped_or_gone(pid):
+    try:
+        return os.waitpid(pid, os.WNOHANG)[0] != 0
+    except ChildProcessError:
+        # Not our child, so all we can do is check whether it still exists.
+        return not check_alive(pid)
+
+
+# Kills all the processes spun off from the current process, then waits up to
+# timeout seconds for them to die. Only the pids that were killed are waited
+# on; a waitpid(-1) here could steal the exit status of a subprocess.Popen
+# owned by another thread. A process tree that forks while it is being killed
+# leaves new children behind, so the sweep is repeated up to attempts times.
+def kill_all_children(pid=str(os.getpid()), timeout=5, attempts=10):
+    for _ in range(attempts):
+        child_pids = sorted(map(int, retrieve_children(pid)))
+
+        if len(child_pids) == 0:
+            return True
 
-    return True
+        # Send the kill signal to each.
+        for child_pid in child_pids:
+            try:
+                os.kill(child_pid, signal.SIGKILL)
+            except OSError:
+                # We couldn't kill the current process (possibly
+                # because it is already dead).
+                pass
+
+        # Poll with a growing delay: most processes are gone within a few
+        # milliseconds of SIGKILL.
+        stragglers = child_pids
+        deadline = time.monotonic() + timeout
+        delay = 0.001
+        while True:
+            stragglers = [p for p in stragglers if not _reaped_or_gone(p)]
+            if not stragglers or time.monotonic() >= deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+        if stragglers:
+            # Could not kill everything. Raise an error to force restart.
+            raise OSError(
+                "Not all of the child processes could be killed during cleanup."
+            )
+
+    # There are still processes that were started up after we identified
+    # those that were to be killed.
+    raise OSError("New processes were begun after children were identified.")
+
+
+# The processes we started ourselves, by pid. The orphan reaper has to leave
+# these for their Popen to wait on, or it would steal their exit status.
+_tracked = weakref.WeakValueDictionary()
+_spawn_lock = threading.Lock()
+
+
+# Starts a subprocess.Popen that reap_orphans() knows to leave alone.
+def popen(*args, **kwargs):
+    with _spawn_lock:
+        process = subprocess.Popen(*args, **kwargs)
+        _tracked[process.pid] = process
+    return process
+
+
+# Returns the PIDs of our direct children, including orphans that have
+# re-parented to us because we are their child subreaper.
+def _own_children():
+    pids = set()
+    have_children_files = False
+    try:
+        tids = os.listdir("/proc/self/task")
+    except OSError:
+        return pids
+    for tid in tids:
+        try:
+            with open(os.path.join("/proc/self/task", tid, "children")) as f:
+                pids.update(map(int, f.read().split()))
+            have_children_files = True
+        except FileNotFoundError:
+            # The thread exited, or the kernel lacks CONFIG_PROC_CHILDREN.
+            pass
+    if have_children_files:
+        return pids
+
+    # Fall back to finding our children by parent PID.
+    me = os.getpid()
+    for pid in get_all_process_pids():
+        try:
+            with open(os.path.join("/proc", pid, "stat")) as f:
+                # The command name is in parentheses and may contain anything.
+                fields = f.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        if int(fields[1]) == me:
+            pids.add(int(pid))
+    return pids
+
+
+# Reaps any of our children that have exited and that no Popen is waiting on,
+# which are the orphans we inherited as the child subreaper. Returns how many
+# were reaped. A child started by a plain subprocess.Popen looks the same as
+# an orphan, so only call this when no other thread may be waiting on one;
+# processes started through popen() are always left alone.
+def reap_orphans():
+    with _spawn_lock:
+        reaped = 0
+        for pid in _own_children():
+            process = _tracked.get(pid)
+            if process is not None and process.returncode is None:
+                continue
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                    reaped += 1
+            except ChildProcessError:
+                pass
+        return reaped
 
 
 # Check all running subprocesses to see if a zombie was created.
 def any_zombies():
-    out, err = subprocess.Popen(["ps", "-ef"], stdout=subprocess.PIPE).communicate()
+    out, err = popen(["ps", "-ef"], stdout=subprocess.PIPE).communicate()
 
     if err is not None:
         raise OSError(
@@ -0,0 +1,7 @@
+import joshua.joshua as joshua
+import doctest
+
+
+def test_doctest():
+    failure_count = doctest.testmod(joshua)[0]
+    assert failure_count == 0
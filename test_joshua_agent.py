@@ -1,7 +1,43 @@
 import joshua.joshua_agent as joshua_agent
 import doctest
+import os
+import pytest
 
 
 def test_doctest():
     failure_count = doctest.testmod(joshua_agent)[0]
     assert failure_count == 0
+
+
+def test_results_writer_failed_write(monkeypatch):
+    written = []
+
+    def insert_results(ensemble, seed, retcode, output, *args):
+        if seed == 1:
+            raise RuntimeError("write failed")
+        written.append(seed)
+
+    monkeypatch.setattr(joshua_agent.joshua_model, "insert_results", insert_results)
+    writer = joshua_agent.ResultsWriter()
+    writer.submit("ensemble", 1, 0, b"")
+    # A failed write must not cost the next result its insert.
+    writer.submit("ensemble", 2, 0, b"")
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert written == [2]
+    # The error is only reported once.
+    writer.flush()
+
+
+def test_sweep_garbage(tmp_path):
+    # Left behind by an agent that was killed before its reaper caught up.
+    (tmp_path / "old.garbage.123.0" / "tmp").mkdir(parents=True)
+    (tmp_path / "kept" / "tmp.garbage.123.1").mkdir(parents=True)
+    (tmp_path / "kept" / "tmp.garbage.123.1" / "console.log").write_bytes(b"")
+    (tmp_path / "kept" / "tmp").mkdir()
+    (tmp_path / "kept" / "joshua_test").write_bytes(b"")
+
+    joshua_agent._sweep_garbage(str(tmp_path))
+
+    assert sorted(os.listdir(tmp_path)) == ["kept"]
+    assert sorted(os.listdir(tmp_path / "kept")) == ["joshua_test", "tmp"]
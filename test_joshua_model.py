@@ -162,11 +162,67 @@ def get_fails(tr: fdb.Transaction, ensemble_id: str) -> int:
     return joshua_model._get_snap_counter(tr, ensemble_id, "fail")
 
 
+@fdb.transactional
+def get_ended(tr: fdb.Transaction, ensemble_id: str) -> int:
+    return joshua_model._get_snap_counter(tr, ensemble_id, "ended")
+
+
+def run_agent_until_done(tmp_path, ensemble_id):
+    agent = threading.Thread(
+        target=joshua_agent.agent,
+        args=(),
+        kwargs={
+            "work_dir": tmp_path,
+            "agent_idle_timeout": 1,
+        },
+    )
+    agent.setDaemon(True)
+    agent.start()
+    joshua.tail_ensemble(ensemble_id, username="joshua")
+    agent.join()
+
+
 def test_create_ensemble():
     assert len(joshua_model.list_active_ensembles()) == 0
     ensemble_id = joshua_model.create_ensemble("joshua", {}, io.BytesIO())
     assert len(joshua_model.list_active_ensembles()) > 0
 
+
+def test_get_latest_active_ensemble():
+    assert joshua_model.get_latest_active_ensemble(False) is None
+    alice = joshua_model.create_ensemble("alice", {"username": "alice"}, io.BytesIO(b"a"))
+    bob = joshua_model.create_ensemble("bob", {"username": "bob"}, io.BytesIO(b"b"))
+    assert joshua_model.get_latest_active_ensemble(False) == max(alice, bob)
+    assert joshua_model.get_latest_active_ensemble(False, username="alice") == alice
+    assert joshua_model.get_latest_active_ensemble(False, username="carol") is None
+    joshua_model.stop_ensemble(alice)
+    assert joshua_model.get_latest_active_ensemble(False, username="alice") is None
+    assert joshua_model.get_latest_active_ensemble(True, username="alice") == alice
+
+
+def test_get_latest_active_ensemble_behind_other_users(monkeypatch):
+    # Enough newer ensembles from someone else to span several batches.
+    monkeypatch.setattr(joshua_model, "LATEST_ENSEMBLE_BATCH", 4)
+    alice = joshua_model.create_ensemble("alice", {"username": "alice"}, io.BytesIO(b"a"))
+    for i in range(10):
+        joshua_model.create_ensemble(
+            "bob", {"username": "bob"}, io.BytesIO(b"b%d" % i)
+        )
+    assert joshua_model.get_latest_active_ensemble(False, username="alice") == alice
+    assert joshua_model.get_latest_active_ensemble(True, username="alice") == alice
+    assert joshua_model.get_latest_active_ensemble(False, username="carol") is None
+    assert joshua_model.get_latest_active_ensemble(True, username="carol") is None
+
+
+def test_get_ensemble_priorities_and_durations():
+    ensemble_id = joshua_model.create_ensemble("joshua", {}, io.BytesIO())
+    priorities = joshua_model.get_ensemble_priorities([ensemble_id])
+    durations = joshua_model.get_ensemble_mean_durations([ensemble_id])
+    assert joshua_model.get_ensemble_priorities_and_durations([ensemble_id]) == {
+        ensemble_id: (priorities[ensemble_id], durations[ensemble_id])
+    }
+
+
 def test_validate_ensemble(tmp_path, empty_ensemble):
     outfile = str(tmp_path) + "/" + "outfile"
     assert len(joshua_model.list_active_ensembles()) == 0
@@ -220,6 +276,185 @@ def test_validate_ensemble_s3(tmp_path, empty_ensemble):
     print(newhash)
     assert orighash == newhash
 
+BLOB_TRANSACTION_LIMIT = joshua_model.BLOB_TRANSACTION_LIMIT
+
+
+def read_blob(subspace) -> bytes:
+    out = io.BytesIO()
+    joshua_model._read_blob(joshua_model.db, subspace, out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize(
+    "size",
+    [
+        0,
+        1,
+        BLOB_TRANSACTION_LIMIT - 1,
+        BLOB_TRANSACTION_LIMIT,
+        BLOB_TRANSACTION_LIMIT + 1,
+        3 * BLOB_TRANSACTION_LIMIT - 1,
+        3 * BLOB_TRANSACTION_LIMIT,
+        3 * BLOB_TRANSACTION_LIMIT + 1,
+        # More windows than _read_blob keeps in flight at once.
+        (joshua_model.BLOB_DOWNLOAD_CONCURRENCY + 2) * BLOB_TRANSACTION_LIMIT,
+    ],
+)
+def test_blob_round_trip(size):
+    subspace = fdb.Subspace(("blob",))
+    data = os.urandom(size)
+    joshua_model._insert_blob(joshua_model.db, subspace, io.BytesIO(data))
+    assert read_blob(subspace) == data
+
+
+def test_insert_blob_multiple_parts():
+    # More parts than _insert_blob keeps committing at once.
+    subspace = fdb.Subspace(("blob",))
+    size = (2 * joshua_model.BLOB_UPLOAD_CONCURRENCY + 1) * joshua_model.BLOB_COMMIT_BYTES
+    data = os.urandom(size + 123)
+    joshua_model._insert_blob(joshua_model.db, subspace, io.BytesIO(data))
+    assert read_blob(subspace) == data
+
+
+def test_insert_blob_retries_failed_commit():
+    subspace = fdb.Subspace(("blob",))
+    data = os.urandom(joshua_model.BLOB_COMMIT_BYTES)
+    tr = joshua_model.db.create_transaction()
+    joshua_model._insert_blobpart(tr, subspace, 0, data)
+
+    # A commit that fails with not_committed. on_error resets the
+    # transaction, so the part has to be written again before it commits.
+    class NotCommitted:
+        def wait(self):
+            raise fdb.FDBError(1020)
+
+    joshua_model._finish_blobpart(tr, subspace, 0, data, NotCommitted())
+    assert read_blob(subspace) == data
+
+
+def test_read_blob_misaligned_keys():
+    # Keys that don't fall on window boundaries make _read_blob fall back to
+    # reading one window after another.
+    subspace = fdb.Subspace(("blob",))
+    data = os.urandom(3 * BLOB_TRANSACTION_LIMIT + 100)
+    step = joshua_model.BLOB_KEY_LIMIT * 3 // 2
+
+    @fdb.transactional
+    def write(tr):
+        for offset in range(0, len(data), step):
+            tr[subspace[offset]] = data[offset : offset + step]
+
+    write(joshua_model.db)
+    assert read_blob(subspace) == data
+
+
+def test_read_blob_resumes_after_transaction_too_old():
+    subspace = fdb.Subspace(("blob",))
+    data = os.urandom(3 * joshua_model.BLOB_DOWNLOAD_CONCURRENCY * BLOB_TRANSACTION_LIMIT)
+    joshua_model._insert_blob(joshua_model.db, subspace, io.BytesIO(data))
+
+    # The first transaction goes too old once it has read a few windows.
+    class TooOldTransaction:
+        def __init__(self, tr):
+            self._tr = tr
+            self._ranges = 0
+
+        def get_range(self, *args, **kwargs):
+            self._ranges += 1
+            if self._ranges > joshua_model.BLOB_DOWNLOAD_CONCURRENCY + 2:
+                raise fdb.FDBError(1007)
+            return self._tr.get_range(*args, **kwargs)
+
+        def __getattr__(self, name):
+            return getattr(self._tr, name)
+
+    class Database:
+        transactions = 0
+
+        def create_transaction(self):
+            Database.transactions += 1
+            tr = joshua_model.db.create_transaction()
+            return TooOldTransaction(tr) if Database.transactions == 1 else tr
+
+    out = io.BytesIO()
+    joshua_model._read_blob(Database(), subspace, out)
+    assert out.getvalue() == data
+    assert Database.transactions == 2
+
+
+def is_active(ensemble_id) -> bool:
+    return ensemble_id in [e for e, _ in joshua_model.list_active_ensembles()]
+
+
+def test_insert_results_stops_at_max_runs():
+    max_runs = 3
+    ensemble_id = joshua_model.create_ensemble(
+        "joshua", {"max_runs": max_runs}, io.BytesIO()
+    )
+    for seed in range(1, max_runs + 1):
+        assert is_active(ensemble_id)
+        assert joshua_model.try_starting_test(ensemble_id, seed)
+        joshua_model.insert_results(
+            ensemble_id, seed, 0, b"", False, max_runs=max_runs, duration=1
+        )
+    assert not is_active(ensemble_id)
+    assert get_ended(joshua_model.db, ensemble_id) == max_runs
+
+
+def test_insert_results_stops_at_fail_fast():
+    fail_fast = 3
+    ensemble_id = joshua_model.create_ensemble(
+        "joshua", {"fail_fast": fail_fast}, io.BytesIO()
+    )
+    # Passes don't count towards fail_fast.
+    seeds = iter(range(1, 100))
+    for _ in range(2):
+        seed = next(seeds)
+        assert joshua_model.try_starting_test(ensemble_id, seed)
+        joshua_model.insert_results(ensemble_id, seed, 0, b"", False, fail_fast=fail_fast)
+    for _ in range(fail_fast):
+        assert is_active(ensemble_id)
+        seed = next(seeds)
+        assert joshua_model.try_starting_test(ensemble_id, seed)
+        joshua_model.insert_results(ensemble_id, seed, 1, b"", False, fail_fast=fail_fast)
+    assert not is_active(ensemble_id)
+    assert get_fails(joshua_model.db, ensemble_id) == fail_fast
+
+
+def test_tail_results_mixes_inline_and_blob_results():
+    large = "x" * (2 * joshua_model.BLOB_KEY_LIMIT)
+    # A message pointing at a blob that can't be read is passed through.
+    unreadable = joshua_model.wrap_message(
+        {"Message": "value_in_blob", "BlobKey": "missing", "BlobVersion": "3"}
+    )
+    outputs = [
+        "small 1",
+        large + "1",
+        "small 2",
+        unreadable.decode(),
+        large + "2",
+        large + "3",
+        "small 3",
+    ]
+    ensemble_id = joshua_model.create_ensemble(
+        "joshua", {"max_runs": len(outputs)}, io.BytesIO()
+    )
+    for seed, output in enumerate(outputs, 1):
+        assert joshua_model.try_starting_test(ensemble_id, seed)
+        joshua_model.insert_results(
+            ensemble_id,
+            seed,
+            seed % 2,
+            output.encode(),
+            False,
+            max_runs=len(outputs),
+        )
+
+    results = list(joshua_model.tail_results(ensemble_id, compressed=False))
+    assert [seed for _, _, _, seed, _ in results] == list(range(1, len(outputs) + 1))
+    assert [output for _, _, _, _, output in results] == outputs
+
+
 def test_agent(tmp_path, empty_ensemble):
     """
     :tmp_path: https://docs.pytest.org/en/stable/tmpdir.html
@@ -415,6 +650,60 @@ def test_ensemble_fails(tmp_path, empty_ensemble_fail):
     assert get_fails(joshua_model.db, ensemble_id) >= 1
 
 
+def test_ensemble_runs_exactly_max_runs(tmp_path, empty_ensemble):
+    # Each result is counted before the agent starts its next run, so a
+    # single agent never starts more than max_runs.
+    ensemble_id = joshua_model.create_ensemble(
+        "joshua", {"max_runs": 3, "timeout": 1}, open(empty_ensemble, "rb")
+    )
+    run_agent_until_done(tmp_path, ensemble_id)
+
+    assert joshua_model.get_ensemble_properties(ensemble_id)["started"] == 3
+    assert get_ended(joshua_model.db, ensemble_id) == 3
+    assert get_passes(joshua_model.db, ensemble_id) == 3
+
+
+def test_ensemble_large_output(tmp_path):
+    # Fill stderr's pipe before writing anything to stdout, so the agent has
+    # to drain both streams at once to collect the output.
+    size = 1 << 20
+    factory = EnsembleFactory.with_script(
+        tmp_path,
+        "head -c {0} /dev/zero | tr '\\0' e >&2\n"
+        "head -c {0} /dev/zero | tr '\\0' o\n".format(size),
+    )
+    factory.done()
+    ensemble_id = joshua_model.create_ensemble(
+        "joshua", {"max_runs": 1, "timeout": 60}, open(factory.file_name, "rb")
+    )
+    run_agent_until_done(tmp_path, ensemble_id)
+
+    results = list(joshua_model.tail_results(ensemble_id, compressed=False))
+    assert len(results) == 1
+    _, result_code, _, _, output = results[0]
+    assert result_code == 0
+    assert output == "o" * size
+
+
+def test_ensemble_timeout(tmp_path):
+    factory = EnsembleFactory(tmp_path)
+    factory.add_bash_script("joshua_test", "echo started; sleep 100000")
+    factory.add_bash_script("joshua_timeout", "echo summarized")
+    factory.done()
+    ensemble_id = joshua_model.create_ensemble(
+        "joshua", {"max_runs": 1, "timeout": 1}, open(factory.file_name, "rb")
+    )
+    run_agent_until_done(tmp_path, ensemble_id)
+
+    results = list(joshua_model.tail_results(ensemble_id, compressed=False))
+    assert len(results) == 1
+    _, result_code, _, _, output = results[0]
+    # A timed out run reports -2 and the timeout command's output.
+    assert result_code == -2
+    assert output == "summarized\n"
+    assert get_fails(joshua_model.db, ensemble_id) == 1
+
+
 def test_delete_ensemble(tmp_path, empty_ensemble_timeout):
     ensemble_id = joshua_model.create_ensemble(
         "joshua", {"max_runs": 10, "timeout": 1}, open(empty_ensemble_timeout, "rb")
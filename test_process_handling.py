@@ -0,0 +1,105 @@
+import ctypes
+import joshua.process_handling as process_handling
+import os
+import pytest
+import subprocess
+import sys
+import time
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="process_handling reads /proc"
+)
+
+PR_SET_CHILD_SUBREAPER = 36
+
+
+@pytest.fixture(scope="module", autouse=True)
+def subreaper():
+    """
+    Make the test process the child subreaper, as the agent does, so that
+    killed grandchildren re-parent to it and can be reaped.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    assert libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+
+
+def test_kill_all_children_forking_tree():
+    env = process_handling.mark_environment(os.environ)
+    tree = subprocess.Popen(
+        ["sh", "-c", "while true; do sleep 100 & sleep 0.001; done"], env=env
+    )
+    assert process_handling.kill_all_children()
+    assert list(process_handling.retrieve_children()) == []
+    tree.wait()
+
+
+def test_kill_all_children_retries_new_children(monkeypatch):
+    env = process_handling.mark_environment(os.environ)
+    retrieve_children = process_handling.retrieve_children
+    forked = []
+
+    # Start a new child right after the first sweep has picked its targets.
+    def retrieve_children_and_fork(pid):
+        children = list(retrieve_children(pid))
+        if not forked:
+            forked.append(subprocess.Popen(["sleep", "100"], env=env))
+        return children
+
+    monkeypatch.setattr(
+        process_handling, "retrieve_children", retrieve_children_and_fork
+    )
+    subprocess.Popen(["sleep", "100"], env=env)
+    assert process_handling.kill_all_children()
+    assert list(retrieve_children()) == []
+
+
+def test_kill_all_children_gives_up(monkeypatch):
+    env = process_handling.mark_environment(os.environ)
+    retrieve_children = process_handling.retrieve_children
+
+    def retrieve_children_and_fork(pid):
+        children = list(retrieve_children(pid))
+        subprocess.Popen(["sleep", "100"], env=env)
+        return children
+
+    monkeypatch.setattr(
+        process_handling, "retrieve_children", retrieve_children_and_fork
+    )
+    subprocess.Popen(["sleep", "100"], env=env)
+    with pytest.raises(OSError, match="New processes were begun"):
+        process_handling.kill_all_children(attempts=3)
+    monkeypatch.undo()
+    assert process_handling.kill_all_children()
+
+
+def wait_until_exited(pid):
+    # The process has exited once it is a zombie, or once it is gone.
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                if f.read().rpartition(")")[2].split()[0] == "Z":
+                    return
+        except FileNotFoundError:
+            return
+        time.sleep(0.01)
+    raise AssertionError("process {} did not exit".format(pid))
+
+
+def test_reap_orphans_leaves_popen_alone():
+    process = process_handling.popen(["sh", "-c", "exit 3"])
+    wait_until_exited(process.pid)
+    process_handling.reap_orphans()
+    assert process.wait() == 3
+
+
+def test_reap_orphans_reaps_orphans():
+    # The background sleep outlives its parent and re-parents to us.
+    process = process_handling.popen(
+        ["sh", "-c", "sleep 0.1 & echo $!"], stdout=subprocess.PIPE
+    )
+    orphan = int(process.communicate()[0])
+    assert process.returncode == 0
+    wait_until_exited(orphan)
+    assert process_handling.reap_orphans() >= 1
+    assert not process_handling.check_alive(orphan)